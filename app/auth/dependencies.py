@@ -1,15 +1,18 @@
+import hmac
 from fastapi import Depends, HTTPException, status
 from fastapi.security import APIKeyHeader
 from typing import Optional
-from ..config import API_KEY, API_KEY_HEADER_NAME
+from ..config import API_KEY_HASH, API_KEY_HEADER_NAME, hash_api_key
 
 api_key_header = APIKeyHeader(name=API_KEY_HEADER_NAME, auto_error=False)
 
 async def verify_api_key(api_key: Optional[str] = Depends(api_key_header)):
-    if not api_key or api_key != API_KEY:
+    # Always hash and compare so the response time doesn't depend on the key
+    valid = hmac.compare_digest(hash_api_key(api_key or ""), API_KEY_HASH)
+    if not valid or not api_key:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or missing API key",
             headers={"WWW-Authenticate": "API-Key"},
         )
-    return api_key
\ No newline at end of file
+    return api_key
@@ -1,16 +1,40 @@
+import hashlib
 import os
 from dotenv import load_dotenv
 
+try:
+    from blake3 import blake3 as _blake3
+except ImportError:
+    _blake3 = None
+
 # Load environment variables from .env file
 load_dotenv()
 
 API_KEY_HEADER_NAME = "x-api-key"
 DEFAULT_API_KEY = "change-me"
 API_KEY = os.getenv("API_KEY", DEFAULT_API_KEY)
+DEBUG = os.getenv("DEBUG") == "1"
+# Run the server on uvloop (libuv) instead of the stock asyncio selector loop
+USE_UVLOOP = os.getenv("USE_UVLOOP", "1") != "0"
+
+# Comma-separated list of origins allowed to call the HTTP API
+ALLOWED_ORIGINS = tuple(
+    origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "*").split(",") if origin.strip()
+)
+
+
+def hash_api_key(api_key: str) -> bytes:
+    """Hash an API key to a fixed-length digest for constant-time comparison"""
+    data = api_key.encode()
+    if _blake3 is not None:
+        return _blake3(data).digest()
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+
+# Precomputed digest of the configured key, compared against hashed client keys
+API_KEY_HASH = hash_api_key(API_KEY or "")
 
-# Debug: Print what API key was loaded (first 8 chars for security)
 if API_KEY:
-    print(f"API Key loaded: {API_KEY[:8]}...")
+    print("API Key loaded")
 else:
     print("No API Key found!")
-
@@ -1,8 +1,49 @@
+import logging
+import os
+import queue
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from app.routes.rtc.web_socket import websocket_router
-from app.config import API_KEY
+from app.config import ALLOWED_ORIGINS, API_KEY, DEBUG, USE_UVLOOP
+
+class _PassthroughQueueHandler(QueueHandler):
+    """Queues records as-is; the listener's handlers do the formatting (uvicorn's
+    access formatter needs the original args)"""
+
+    def prepare(self, record):
+        return record
+
+def _queue_log_handlers(*names):
+    """Move each logger's handlers behind a QueueListener thread, so logging on
+    the event loop never blocks on a stream write"""
+    queued = []
+    for name in names:
+        logger = logging.getLogger(name)
+        if not logger.handlers:
+            continue  # records propagate to a parent that is handled here
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, *logger.handlers, respect_handler_level=True)
+        logger.handlers = [_PassthroughQueueHandler(log_queue)]
+        listener.start()
+        queued.append((logger, listener))
+    return queued
+
+def _restore_log_handlers(queued):
+    """Flush the queues and hand the handlers back to their loggers"""
+    for logger, listener in queued:
+        listener.stop()
+        logger.handlers = list(listener.handlers)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Route logging through queue listeners for the lifetime of the app"""
+    # uvicorn has configured its loggers by now
+    queued_loggers = _queue_log_handlers("", "uvicorn", "uvicorn.access")
+    yield
+    _restore_log_handlers(queued_loggers)
 
 # Create FastAPI app instance
 app = FastAPI(
@@ -10,14 +51,16 @@ app = FastAPI(
     description="WebSocket server for real-time communication and WebRTC streaming",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
-# Add CORS middleware for WebSocket connections
+# Add CORS middleware for the HTTP API. WebSocket upgrades bypass it, and
+# clients authenticate with the API key header rather than cookies, so
+# credentials are not allowed.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Configure this appropriately for production
-    allow_credentials=True,
+    allow_origins=ALLOWED_ORIGINS,  # Set ALLOWED_ORIGINS for production
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -37,20 +80,31 @@ async def root():
 
 @app.get("/api-key-info")
 async def api_key_info():
-    """Get API key information (for development/testing)"""
+    """Get API key information (for development/testing, only served with DEBUG=1)"""
+    if not DEBUG:
+        raise HTTPException(status_code=404)
     return {
         "api_key_header": "x-api-key",
-        "api_key_exists": bool(API_KEY),
-        "api_key_length": len(API_KEY) if API_KEY else 0
+        "api_key_exists": bool(API_KEY)
     }
 
 if __name__ == "__main__":
-    # Run the server
+    # Rooms, signaling sockets and peer connections live in this process, so
+    # run a single worker; peers of one room on different workers would never
+    # see each other. Scale out only behind a balancer that pins each room to
+    # one worker.
+    dev = os.getenv("DEV") == "1"
     uvicorn.run(
         "app.main:app",
         host="0.0.0.0",  # Bind to all available network interfaces
         port=8000,        # Default port
-        reload=True,      # Enable auto-reload for development
+        reload=dev,       # Enable auto-reload for development
+        loop="uvloop" if USE_UVLOOP else "asyncio",  # libuv-based event loop
+        http="httptools", # C HTTP parser
+        limit_concurrency=1000,
+        timeout_keep_alive=30,
+        ws_ping_interval=20,  # Protocol-level keepalive: peers that vanish
+        ws_ping_timeout=20,   # without a close frame are dropped within ~40s
         log_level="info",
-        access_log=True
-    )
\ No newline at end of file
+        access_log=dev    # Access logs are synchronous writes on the event loop
+    )
@@ -0,0 +1,149 @@
+"""
+Compiled sample conversion and mixing kernels for the audio playback paths
+"""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    # Numba is optional, the NumPy ufunc versions below are used instead
+    njit = None
+
+_INT16_SCALE = np.float32(1.0 / 32768.0)
+_INT32_SCALE = np.float32(1.0 / 2147483648.0)
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _scale_to_float32(src, out, scale):
+        n, channels = src.shape
+        for i in range(n):
+            for c in range(channels):
+                out[i, c] = src[i, c] * scale
+
+    @njit(cache=True, fastmath=True)
+    def _copy_to_float32(src, out):
+        n, channels = src.shape
+        for i in range(n):
+            for c in range(channels):
+                out[i, c] = src[i, c]
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def mix(out, bufs, vols):
+        """Weighted sum of the (peers, samples) ``bufs`` rows into ``out`` in one pass"""
+        peers = vols.size
+        for i in prange(out.size):
+            s = np.float32(0.0)
+            for k in range(peers):
+                s += bufs[k, i] * vols[k]
+            out[i] = s
+
+    @njit(parallel=True, cache=True)
+    def mix_q15(out, bufs, vols):
+        """Q15-weighted sum of int16 ``bufs`` rows into int16 ``out``, saturating"""
+        peers = vols.size
+        for i in prange(out.size):
+            s = np.int64(0)
+            for k in range(peers):
+                s += np.int64(bufs[k, i]) * vols[k]
+            s = (s + 0x4000) >> 15
+            if s > 32767:
+                s = 32767
+            elif s < -32768:
+                s = -32768
+            out[i] = s
+
+    @njit(parallel=True, cache=True)
+    def mix_int16(out, bufs):
+        """Unweighted sum of int16 ``bufs`` rows into int16 ``out``, saturating"""
+        peers = bufs.shape[0]
+        for i in prange(out.size):
+            s = np.int32(0)
+            for k in range(peers):
+                s += bufs[k, i]
+            if s > 32767:
+                s = 32767
+            elif s < -32768:
+                s = -32768
+            out[i] = s
+
+    @njit(cache=True)
+    def q15_scale(buf, vol):
+        """Scale int16 ``buf`` in place by a Q15 gain with rounding and saturation (PMULHRSW semantics)"""
+        for i in range(buf.size):
+            s = (np.int64(buf[i]) * vol + 0x4000) >> 15
+            if s > 32767:
+                s = 32767
+            elif s < -32768:
+                s = -32768
+            buf[i] = s
+
+    @njit(cache=True, fastmath=True)
+    def float32_to_int16(src, out):
+        """Clip float32 samples to [-1, 1] and quantize them into int16 ``out``"""
+        for i in range(src.size):
+            v = src[i] * np.float32(32767.0)
+            if v > 32767.0:
+                v = 32767.0
+            elif v < -32768.0:
+                v = -32768.0
+            out[i] = np.int16(v)
+else:
+    def _scale_to_float32(src, out, scale):
+        np.multiply(src, scale, out=out, dtype=np.float32, casting='unsafe')
+
+    def _copy_to_float32(src, out):
+        np.copyto(out, src, casting='unsafe')
+
+    def mix(out, bufs, vols):
+        """Weighted sum of the (peers, samples) ``bufs`` rows into ``out`` in one pass"""
+        np.dot(vols, bufs, out=out)
+
+    def mix_q15(out, bufs, vols):
+        """Q15-weighted sum of int16 ``bufs`` rows into int16 ``out``, saturating"""
+        acc = np.dot(vols, bufs)
+        acc += 0x4000
+        np.right_shift(acc, 15, out=acc)
+        np.clip(acc, -32768, 32767, out=acc)
+        np.copyto(out, acc, casting='unsafe')
+
+    def mix_int16(out, bufs):
+        """Unweighted sum of int16 ``bufs`` rows into int16 ``out``, saturating"""
+        acc = np.sum(bufs, axis=0, dtype=np.int32)
+        np.clip(acc, -32768, 32767, out=acc)
+        np.copyto(out, acc, casting='unsafe')
+
+    def q15_scale(buf, vol):
+        """Scale int16 ``buf`` in place by a Q15 gain with rounding and saturation (PMULHRSW semantics)"""
+        acc = np.multiply(buf, vol, dtype=np.int64)
+        acc += 0x4000
+        np.right_shift(acc, 15, out=acc)
+        np.clip(acc, -32768, 32767, out=acc)
+        np.copyto(buf, acc, casting='unsafe')
+
+    def float32_to_int16(src, out):
+        """Clip float32 samples to [-1, 1] and quantize them into int16 ``out``"""
+        np.multiply(np.clip(src, -1.0, 1.0), 32767.0, out=out, casting='unsafe')
+
+def to_float32(src: np.ndarray, out: np.ndarray):
+    """Convert (samples, channels) PCM into float32 ``out``, normalizing integer formats to [-1, 1]"""
+    if src.dtype == np.int16:
+        _scale_to_float32(src, out, _INT16_SCALE)
+    elif src.dtype == np.int32:
+        _scale_to_float32(src, out, _INT32_SCALE)
+    else:
+        _copy_to_float32(src, out)
+
+# Compile the packed and per-plane int16 paths at import so the first peer
+# doesn't pay the JIT latency
+to_float32(np.zeros((2, 2), dtype=np.int16), np.zeros((2, 2), dtype=np.float32))
+to_float32(np.zeros((2, 1), dtype=np.int16), np.zeros((2, 2), dtype=np.float32)[:, :1])
+# Same for the mixer, with full and truncated chunk matrices
+mix(np.zeros(2, dtype=np.float32), np.zeros((1, 2), dtype=np.float32), np.ones(1, dtype=np.float32))
+mix(np.zeros(1, dtype=np.float32), np.zeros((1, 2), dtype=np.float32)[:, :1], np.ones(1, dtype=np.float32))
+mix_q15(np.zeros(2, dtype=np.int16), np.zeros((1, 2), dtype=np.int16), np.ones(1, dtype=np.int64))
+mix_q15(np.zeros(1, dtype=np.int16), np.zeros((1, 2), dtype=np.int16)[:, :1], np.ones(1, dtype=np.int64))
+mix_int16(np.zeros(2, dtype=np.int16), np.zeros((1, 2), dtype=np.int16))
+mix_int16(np.zeros(1, dtype=np.int16), np.zeros((1, 2), dtype=np.int16)[:, :1])
+q15_scale(np.zeros(2, dtype=np.int16), np.int64(1))
+float32_to_int16(np.zeros(2, dtype=np.float32), np.zeros(2, dtype=np.int16))
@@ -4,30 +4,44 @@ Audio Handler for WebRTC audio stream processing
 
 import asyncio
 import logging
-import numpy as np
-from typing import Optional, Callable, Dict, Any
+from dataclasses import asdict, dataclass
+from typing import Optional, Callable, Dict, Any, Tuple
 from aiortc.contrib.media import MediaStreamTrack, MediaPlayer, MediaRecorder
 from aiortc.mediastreams import MediaStreamError
 
 logger = logging.getLogger(__name__)
 
+@dataclass(slots=True)
+class PeerAudioStats:
+    """Audio track statistics for one peer"""
+    track_active: bool = False
+    track_type: str = ""
+    timestamp: float = 0.0
+
 class AudioStreamHandler:
     """Handles audio stream processing and management"""
     
     def __init__(self):
-        self.audio_processors: Dict[str, Callable] = {}
+        # name -> (processor, is_passthrough)
+        self.audio_processors: Dict[str, Tuple[Callable, bool]] = {}
         self.recorders: Dict[str, MediaRecorder] = {}
-        self.audio_stats: Dict[str, Dict[str, Any]] = {}
+        self.audio_stats: Dict[str, PeerAudioStats] = {}
     
     async def process_audio_track(self, peer_id: str, track: MediaStreamTrack, 
                                 processor_type: str = "default") -> MediaStreamTrack:
         """Process an audio track with specified processor"""
         try:
-            if processor_type not in self.audio_processors:
+            entry = self.audio_processors.get(processor_type)
+            if entry is None:
                 logger.warning(f"Unknown processor type: {processor_type}, using default")
                 processor_type = "default"
+                entry = self.audio_processors[processor_type]
+            
+            processor, is_passthrough = entry
             
-            processor = self.audio_processors[processor_type]
+            # Passthrough processors return the track unchanged, skip the call
+            if is_passthrough:
+                return track
             
             # Call the processor function
             result = await processor(peer_id, track)
@@ -37,7 +51,7 @@ class AudioStreamHandler:
                 logger.warning(f"Processor {processor_type} returned None, returning original track")
                 return track
             
-            if not isinstance(result, MediaStreamTrack):
+            if __debug__ and not isinstance(result, MediaStreamTrack):
                 logger.warning(f"Processor {processor_type} returned invalid type {type(result)}, returning original track")
                 return track
             
@@ -48,9 +62,14 @@ class AudioStreamHandler:
             # Return the original track if processing fails
             return track
     
-    def register_audio_processor(self, name: str, processor: Callable):
-        """Register a custom audio processor"""
-        self.audio_processors[name] = processor
+    def has_active_processors(self, peer_id: str, processor_type: str = "default") -> bool:
+        """Whether processing peer_id's track would do anything beyond passing it through"""
+        entry = self.audio_processors.get(processor_type)
+        return entry is not None and not entry[1]
+    
+    def register_audio_processor(self, name: str, processor: Callable, passthrough: bool = False):
+        """Register a custom audio processor, flagging ones that return the track unchanged"""
+        self.audio_processors[name] = (processor, passthrough)
         logger.info(f"Registered audio processor: {name}")
     
     async def start_recording(self, peer_id: str, filename: str) -> bool:
@@ -85,15 +104,27 @@ class AudioStreamHandler:
             logger.error(f"Failed to stop recording for peer {peer_id}: {e}")
             return False
     
+    def get_or_create(self, peer_id: str) -> PeerAudioStats:
+        """Get the live statistics record for a peer, creating it on first use"""
+        stats = self.audio_stats.get(peer_id)
+        if stats is None:
+            stats = self.audio_stats[peer_id] = PeerAudioStats()
+        return stats
+    
     def get_audio_stats(self, peer_id: str) -> Dict[str, Any]:
         """Get audio statistics for a peer"""
-        return self.audio_stats.get(peer_id, {})
+        stats = self.audio_stats.get(peer_id)
+        return asdict(stats) if stats is not None else {}
+    
+    def get_all_audio_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get audio statistics for all peers"""
+        return {peer_id: asdict(stats) for peer_id, stats in self.audio_stats.items()}
     
     def update_audio_stats(self, peer_id: str, stats: Dict[str, Any]):
-        """Update audio statistics for a peer"""
-        if peer_id not in self.audio_stats:
-            self.audio_stats[peer_id] = {}
-        self.audio_stats[peer_id].update(stats)
+        """Update audio statistics for a peer; keys must be PeerAudioStats fields"""
+        record = self.get_or_create(peer_id)
+        for key, value in stats.items():
+            setattr(record, key, value)
 
 class AudioProcessor:
     """Base class for audio processors"""
@@ -146,10 +177,16 @@ class AudioFilter(AudioProcessor):
         # For now, return the original track
         return track
 
+# The default processors are stateless, so every handler shares one set
+_DEFAULT_PROCESSORS = (
+    ("default", DefaultAudioProcessor().process, True),
+    ("transcode", AudioTranscoder().process, False),
+    ("filter", AudioFilter().process, False),
+)
+
 # Initialize default audio processors
 def initialize_audio_processors(handler: AudioStreamHandler):
     """Initialize default audio processors"""
-    handler.register_audio_processor("default", DefaultAudioProcessor().process)
-    handler.register_audio_processor("transcode", AudioTranscoder().process)
-    handler.register_audio_processor("filter", AudioFilter().process)
+    for name, processor, passthrough in _DEFAULT_PROCESSORS:
+        handler.register_audio_processor(name, processor, passthrough=passthrough)
     logger.info("Initialized default audio processors") 
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+Server-side mixing of a room's audio tracks into a single track
+"""
+
+import asyncio
+import fractions
+import logging
+import time
+from typing import Dict
+
+import numpy as np
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from av import AudioFrame
+
+from ._audio_kernels import mix_int16
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 48000
+FRAME_SAMPLES = 960  # 20 ms, the frame size aiortc's Opus decoder produces
+FRAME_DURATION = FRAME_SAMPLES / SAMPLE_RATE
+_TIME_BASE = fractions.Fraction(1, SAMPLE_RATE)
+
+
+class AudioMixerTrack(MediaStreamTrack):
+    """Audio track that mixes the latest frame of every source each 20 ms, MCU-style.
+
+    Each source is drained by its own reader task into a one-frame slot, so a
+    silent (muted, DTX) or slow source never holds up the mix; the mixer runs
+    on its own clock and sums whatever has arrived since the previous tick.
+    Sources must deliver s16 frames at SAMPLE_RATE (what aiortc decodes Opus
+    into); frames in any other format or layout are dropped from the mix.
+    """
+
+    kind = "audio"
+
+    def __init__(self, layout: str = "stereo"):
+        super().__init__()
+        self.layout = layout
+        self._channels = 2 if layout == "stereo" else 1
+        # Reused across recv() calls, sized for one full frame from each source
+        self._stack = np.zeros((1, FRAME_SAMPLES * self._channels), dtype=np.int16)
+        self._out = np.empty(self._stack.shape[1], dtype=np.int16)
+        self._readers: Dict[str, asyncio.Task] = {}
+        self._latest: Dict[str, np.ndarray] = {}  # peer_id -> newest unmixed frame
+        self._timestamp = 0
+        self._start = None
+        self.dropped_frames = 0
+
+    def add_source(self, peer_id: str, track: MediaStreamTrack):
+        """Mix a peer's track in from the next frame on"""
+        self.remove_source(peer_id)
+        self._readers[peer_id] = asyncio.get_running_loop().create_task(self._read(peer_id, track))
+
+    def remove_source(self, peer_id: str):
+        reader = self._readers.pop(peer_id, None)
+        if reader is not None:
+            reader.cancel()
+        self._latest.pop(peer_id, None)
+
+    @property
+    def source_count(self) -> int:
+        return len(self._readers)
+
+    async def _read(self, peer_id: str, track: MediaStreamTrack):
+        """Keep the source's newest frame in its slot; a frame the mixer hasn't
+        taken yet is replaced rather than queued"""
+        try:
+            while True:
+                frame = await track.recv()
+                if frame.format.name != "s16" or frame.layout.name != self.layout or frame.sample_rate != SAMPLE_RATE:
+                    self.dropped_frames += 1
+                    continue
+                self._latest[peer_id] = np.frombuffer(
+                    frame.planes[0], dtype=np.int16, count=frame.samples * self._channels)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The peer's track ended (or failed); it leaves the mix
+            logger.info(f"Removing audio source {peer_id} from mix: {e!r}")
+            if self._readers.get(peer_id) is asyncio.current_task():
+                del self._readers[peer_id]
+            self._latest.pop(peer_id, None)
+
+    def _buffers(self, peers: int, n: int):
+        """(peers, n) int16 stacking matrix plus the int16 output row, grown only when needed"""
+        if self._stack.shape[0] < peers or self._stack.shape[1] < n:
+            self._stack = np.zeros((max(peers, self._stack.shape[0]), max(n, self._stack.shape[1])), dtype=np.int16)
+            self._out = np.empty(self._stack.shape[1], dtype=np.int16)
+        return self._stack[:peers, :n], self._out[:n]
+
+    def _mix(self, arrs) -> AudioFrame:
+        # Saturating int16 sum in one compiled pass; sources that delivered
+        # a short frame only contribute the samples they have
+        n = max(a.size for a in arrs)
+        stack, out = self._buffers(len(arrs), n)
+        for row, a in zip(stack, arrs):
+            row[:a.size] = a
+            row[a.size:] = 0
+        mix_int16(out, stack)
+        frame = AudioFrame(format="s16", layout=self.layout, samples=n // self._channels)
+        frame.planes[0].update(out)
+        return frame
+
+    def _silence(self) -> AudioFrame:
+        frame = AudioFrame(format="s16", layout=self.layout, samples=FRAME_SAMPLES)
+        for plane in frame.planes:
+            plane.update(bytes(plane.buffer_size))
+        return frame
+
+    async def recv(self) -> AudioFrame:
+        if self.readyState != "live":
+            raise MediaStreamError
+
+        # The mixer keeps real time itself like AudioStreamTrack does, so the
+        # output never waits on any one source
+        if self._start is None:
+            self._start = time.monotonic()
+        wait = self._start + self._timestamp / SAMPLE_RATE - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        arrs = list(self._latest.values())
+        self._latest.clear()
+        frame = self._mix(arrs) if arrs else self._silence()
+
+        frame.pts = self._timestamp
+        frame.sample_rate = SAMPLE_RATE
+        frame.time_base = _TIME_BASE
+        self._timestamp += frame.samples
+        return frame
+
+    def stop(self):
+        super().stop()
+        for peer_id in list(self._readers):
+            self.remove_source(peer_id)
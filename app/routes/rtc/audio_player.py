@@ -1,22 +1,118 @@
 import asyncio
+import functools
 import sounddevice as sd
 import numpy as np
 from aiortc import MediaStreamTrack
 import logging
 from typing import Optional
 import threading
-import queue
+from concurrent.futures import Executor
+from ._audio_kernels import to_float32
 
 logger = logging.getLogger(__name__)
 
+# Preallocated frame buffers are sized for the largest frame we expect:
+# 120 ms at 48 kHz (the longest Opus frame), up to stereo.
+MAX_FRAME_SAMPLES = 5760
+MAX_CHANNELS = 2
+_SLOT_SIZE = MAX_FRAME_SAMPLES * MAX_CHANNELS
+FRAME_DURATION = 0.02  # WebRTC audio frames are 20 ms
+
+# PyAV sample format name -> NumPy dtype of its planes
+_AV_TO_NP_DTYPE = {
+    "s16": np.int16, "s16p": np.int16,
+    "s32": np.int32, "s32p": np.int32,
+    "flt": np.float32, "fltp": np.float32,
+    "dbl": np.float64, "dblp": np.float64,
+}
+
+@functools.lru_cache(maxsize=1)
+def _cached_devices():
+    """Query PortAudio devices once per process"""
+    return sd.query_devices()
+
+@functools.lru_cache(maxsize=1)
+def _cached_default_output() -> Optional[int]:
+    """Index of the first device with output channels, or None"""
+    for i, device in enumerate(_cached_devices()):
+        if device['max_outputs'] > 0:
+            return i
+    return None
+
+class FrameRing:
+    """
+    Single-producer/single-consumer ring of preallocated float32 frame buffers.
+
+    Only the receiver advances ``_tail`` and only the playback worker advances
+    ``_head``. Each counter has a single writer and int stores are atomic under
+    the GIL, so the fast path takes no lock; the event is only waited on when
+    the ring is empty.
+    """
+    
+    def __init__(self, capacity: int, slot_size: int = _SLOT_SIZE):
+        self.capacity = capacity
+        self._slots = [np.empty(slot_size, dtype=np.float32) for _ in range(capacity)]
+        self._shapes = [(0, 0)] * capacity
+        self._head = 0  # Next frame to play, owned by the consumer
+        self._tail = 0  # Next slot to fill, owned by the producer
+        self._not_empty = threading.Event()
+    
+    def __len__(self) -> int:
+        return self._tail - self._head
+    
+    def reserve(self, shape) -> Optional[np.ndarray]:
+        """Producer: view the next free slot as ``shape``, or None if the ring is full"""
+        if self._tail - self._head >= self.capacity:
+            return None
+        index = self._tail % self.capacity
+        size = shape[0] * shape[1]
+        if size > self._slots[index].size:
+            # Oversized frame: grow this slot once and keep it
+            self._slots[index] = np.empty(size, dtype=np.float32)
+        self._shapes[index] = shape
+        return self._slots[index][:size].reshape(shape)
+    
+    def commit(self):
+        """Producer: publish the slot filled after reserve()"""
+        self._tail += 1
+        self._not_empty.set()
+    
+    def peek(self, timeout: float) -> Optional[np.ndarray]:
+        """Consumer: view of the oldest frame, waiting up to timeout seconds"""
+        if self._head == self._tail:
+            self._not_empty.clear()
+            # Re-check after clearing so a commit in between isn't missed
+            if self._head == self._tail and not self._not_empty.wait(timeout):
+                return None
+        index = self._head % self.capacity
+        shape = self._shapes[index]
+        return self._slots[index][:shape[0] * shape[1]].reshape(shape)
+    
+    def release(self):
+        """Consumer: hand the slot returned by peek() back to the producer"""
+        self._head += 1
+
 class AudioPlayer:
-    def __init__(self, track: MediaStreamTrack, device_id: Optional[int] = None):
+    def __init__(self, track: MediaStreamTrack, device_id: Optional[int] = None,
+                 executor: Optional[Executor] = None):
         self.track = track
         self.device_id = device_id
-        self.is_playing = False
-        self.audio_queue = queue.Queue(maxsize=100)  # Buffer for audio frames
+        # Executor the blocking playback worker runs on; None uses the event
+        # loop's default executor
+        self.executor = executor
+        self._future: Optional[asyncio.Future] = None
+        self._run_event = threading.Event()  # Set while playing
+        self.audio_queue = FrameRing(capacity=100)  # Buffer for audio frames
         self.sample_rate = 48000  # Default sample rate
         self.channels = 1  # Default mono
+        self.blocksize = int(self.sample_rate * FRAME_DURATION)
+        # Output stream, opened on the first start() and kept for the player's lifetime
+        self._stream: Optional[sd.OutputStream] = None
+        
+        # Scratch buffers for mono<->stereo conversion. sounddevice only accepts
+        # C-contiguous arrays, so a broadcast view won't do; reuse these instead.
+        self._stereo_buf = np.empty((MAX_FRAME_SAMPLES, 2), dtype=np.float32)
+        self._mono_buf = np.empty((MAX_FRAME_SAMPLES, 1), dtype=np.float32)
         
         # Auto-detect audio device if not specified
         if self.device_id is None:
@@ -27,15 +123,33 @@ class AudioPlayer:
             logger.warning(f"Invalid audio device {self.device_id}, using default")
             self.device_id = self._get_default_output_device()
     
+    @property
+    def is_playing(self) -> bool:
+        return self._run_event.is_set()
+    
+    @is_playing.setter
+    def is_playing(self, value: bool):
+        if value:
+            self._run_event.set()
+        else:
+            self._run_event.clear()
+    
     async def start(self):
         """Start playing audio from the track"""
         try:
             logger.info("Starting audio player...")
             self.is_playing = True
             
-            # Start audio playback in a separate thread
-            playback_thread = threading.Thread(target=self._playback_worker, daemon=True)
-            playback_thread.start()
+            # Pull the first frame before opening the stream so the stream
+            # matches the track's sample rate and channel layout
+            frame = await self.track.recv()
+            self._enqueue_frame(frame)
+            self._ensure_stream()
+            self._stream.start()
+            
+            # Start audio playback on the shared executor
+            loop = asyncio.get_running_loop()
+            self._future = loop.run_in_executor(self.executor, self._playback_worker)
             
             # Start receiving frames from the track
             await self._receive_frames()
@@ -45,55 +159,81 @@ class AudioPlayer:
             self.is_playing = False
             raise
     
+    def _ensure_stream(self):
+        """Open the output stream, or reopen it if the rate, layout or device changed"""
+        stream = self._stream
+        if (stream is not None and stream.samplerate == self.sample_rate
+                and stream.channels == self.channels and stream.device == self.device_id):
+            return
+        if stream is not None:
+            stream.close()
+        
+        # One block per WebRTC frame, so PortAudio never stitches partial frames
+        self.blocksize = int(self.sample_rate * FRAME_DURATION)
+        self._stream = sd.OutputStream(
+            samplerate=self.sample_rate,
+            channels=self.channels,
+            dtype=np.float32,
+            device=self.device_id,
+            blocksize=self.blocksize,
+            latency='low',
+            prime_output_buffers_using_stream_callback=False
+        )
+        logger.info(f"Opened output stream - Sample rate: {self.sample_rate}, Channels: {self.channels}, Blocksize: {self.blocksize}")
+    
+    def _enqueue_frame(self, frame):
+        """Convert a received frame into the next ring slot"""
+        # Update sample rate and channels from the frame
+        if frame.sample_rate and frame.sample_rate != self.sample_rate:
+            self.sample_rate = frame.sample_rate
+            logger.info(f"Audio sample rate: {self.sample_rate} Hz")
+        
+        # Detect channels from frame
+        detected_channels = len(frame.layout.channels)
+        if detected_channels != self.channels:
+            logger.info(f"Detected {detected_channels} channels, updating from {self.channels}")
+            self.channels = detected_channels
+        
+        # Convert straight into the next ring slot, normalizing to
+        # [-1, 1] in the same pass
+        out = self.audio_queue.reserve((frame.samples, detected_channels))
+        if out is None:
+            # Playback is a full ring behind, drop this frame
+            return
+        
+        # Read the samples through NumPy views over the AVFrame planes
+        # (linesize may be padded, hence the slicing) rather than
+        # to_ndarray(), which copies. The views alias the frame's
+        # buffer and are only read by to_float32() below, while
+        # `frame` is still referenced, so they never outlive it.
+        dtype = _AV_TO_NP_DTYPE.get(frame.format.name)
+        if dtype is None:
+            raw = frame.to_ndarray()
+            to_float32(raw.T if frame.format.is_planar else raw.reshape(out.shape), out)
+        elif frame.format.is_planar:
+            # One plane per channel
+            for c, plane in enumerate(frame.planes[:detected_channels]):
+                view = np.frombuffer(plane, dtype=dtype, count=frame.samples)
+                to_float32(view.reshape(-1, 1), out[:, c:c + 1])
+        else:
+            view = np.frombuffer(frame.planes[0], dtype=dtype, count=out.size)
+            to_float32(view.reshape(out.shape), out)
+        self.audio_queue.commit()
+    
     async def _receive_frames(self):
         """Receive audio frames from the track and put them in the queue"""
+        # Hot loop: bind attribute lookups to locals once
+        is_playing = self._run_event.is_set
+        recv = self.track.recv
+        wait_for = asyncio.wait_for
+        enqueue = self._enqueue_frame
         try:
-            while self.is_playing:
+            while is_playing():
                 try:
                     # Receive frame with timeout to allow graceful shutdown
-                    frame = await asyncio.wait_for(self.track.recv(), timeout=1.0)
+                    frame = await wait_for(recv(), timeout=1.0)
+                    enqueue(frame)
                     
-                    # Update sample rate and channels from first frame
-                    if frame.sample_rate:
-                        self.sample_rate = frame.sample_rate
-                        logger.info(f"Audio sample rate: {self.sample_rate} Hz")
-                    
-                    # Detect channels from frame
-                    samples = frame.to_ndarray()
-                    if len(samples.shape) > 1:
-                        detected_channels = samples.shape[1]
-                    else:
-                        detected_channels = 1
-                    
-                    if detected_channels != self.channels:
-                        logger.info(f"Detected {detected_channels} channels, updating from {self.channels}")
-                        self.channels = detected_channels
-                    
-                    # Handle different audio formats
-                    if samples.dtype != np.float32:
-                        # Convert to float32 and normalize to [-1, 1] range
-                        if samples.dtype == np.int16:
-                            samples = samples.astype(np.float32) / 32768.0
-                        elif samples.dtype == np.int32:
-                            samples = samples.astype(np.float32) / 2147483648.0
-                        else:
-                            samples = samples.astype(np.float32)
-                    
-                    # Ensure samples are 2D (samples, channels)
-                    if len(samples.shape) == 1:
-                        samples = samples.reshape(-1, 1)
-                    
-                    # Put in queue (non-blocking)
-                    try:
-                        self.audio_queue.put_nowait(samples)
-                    except queue.Full:
-                        # Queue is full, drop oldest frame
-                        try:
-                            self.audio_queue.get_nowait()
-                            self.audio_queue.put_nowait(samples)
-                        except queue.Empty:
-                            pass
-                            
                 except asyncio.TimeoutError:
                     # No frame received within timeout, continue
                     continue
@@ -109,40 +249,62 @@ class AudioPlayer:
     def _playback_worker(self):
         """Worker thread for audio playback"""
         try:
-            logger.info(f"Audio playback worker started - Sample rate: {self.sample_rate}, Channels: {self.channels}")
+            stream = self._stream
+            blocksize = self.blocksize
+            logger.info("Audio playback worker started")
             
-            # Configure sounddevice
-            sd.default.samplerate = self.sample_rate
-            sd.default.channels = self.channels
-            sd.default.device = self.device_id
+            # Frames are coalesced into writes of at least one block so each
+            # stream.write crosses into PortAudio less often. The batch holds
+            # at most 4 blocks (80 ms) and is flushed as soon as the ring runs
+            # dry, so batching never holds back audio.
+            channels = stream.channels
+            batch = np.empty((blocksize * 4, channels), dtype=np.float32)
+            filled = 0
             
-            # Create output stream
-            with sd.OutputStream(
-                samplerate=self.sample_rate,
-                channels=self.channels,
-                dtype=np.float32,
-                device=self.device_id,
-                blocksize=1024,  # Adjust based on your needs
-                latency='low'
-            ) as stream:
-                
-                while self.is_playing:
-                    try:
-                        # Get audio frame from queue
-                        samples = self.audio_queue.get(timeout=0.1)
-                        
-                        # Handle channel conversion if needed
-                        samples = self._ensure_correct_channels(samples, self.channels)
-                        
-                        # Play the audio
-                        stream.write(samples)
-                        
-                    except queue.Empty:
-                        # No audio data, continue
+            # Hot loop: bind attribute lookups to locals once
+            is_playing = self._run_event.is_set
+            write = stream.write
+            peek = self.audio_queue.peek
+            release = self.audio_queue.release
+            ensure_channels = self._ensure_correct_channels
+            
+            while is_playing():
+                try:
+                    # Get audio frame from the ring, don't wait if a batch is pending
+                    samples = peek(timeout=0 if filled else 0.1)
+                    if samples is None:
+                        # No more audio data, play what has been batched
+                        if filled:
+                            write(batch[:filled])
+                            filled = 0
                         continue
-                    except Exception as e:
-                        logger.error(f"Error in playback: {e}")
-                        break
+                    
+                    # Handle channel conversion if needed
+                    samples = ensure_channels(samples, channels)
+                    n = samples.shape[0]
+                    
+                    if filled + n > len(batch):
+                        if filled:
+                            write(batch[:filled])
+                            filled = 0
+                        if n > len(batch):
+                            # Frame larger than the batch, play it directly
+                            write(samples)
+                            release()
+                            continue
+                    
+                    # Copy into the batch, then hand the slot back to the receiver
+                    batch[filled:filled + n] = samples
+                    filled += n
+                    release()
+                    
+                    if filled >= blocksize:
+                        write(batch[:filled])
+                        filled = 0
+                    
+                except Exception as e:
+                    logger.error(f"Error in playback: {e}")
+                    break
                         
         except Exception as e:
             logger.error(f"Error in playback worker: {e}")
@@ -157,14 +319,24 @@ class AudioPlayer:
             if current_channels == target_channels:
                 return samples
             
-            logger.info(f"Converting audio from {current_channels} to {target_channels} channels")
+            logger.debug(f"Converting audio from {current_channels} to {target_channels} channels")
             
+            n = samples.shape[0]
             if current_channels == 1 and target_channels == 2:
-                # Mono to stereo: duplicate the mono channel
-                return np.column_stack([samples, samples])
+                # Mono to stereo: broadcast the mono channel into both columns
+                if n > MAX_FRAME_SAMPLES:
+                    return np.column_stack([samples, samples])
+                stereo = self._stereo_buf[:n]
+                np.copyto(stereo, samples)
+                return stereo
             elif current_channels == 2 and target_channels == 1:
                 # Stereo to mono: average the channels
-                return np.mean(samples, axis=1, keepdims=True)
+                if n > MAX_FRAME_SAMPLES:
+                    return np.mean(samples, axis=1, keepdims=True)
+                mono = self._mono_buf[:n]
+                np.add(samples[:, 0], samples[:, 1], out=mono[:, 0])
+                mono *= 0.5
+                return mono
             elif current_channels > target_channels:
                 # More channels to fewer: take first N channels
                 return samples[:, :target_channels]
@@ -182,15 +354,34 @@ class AudioPlayer:
             # Return original samples if conversion fails
             return samples
     
-    def stop(self):
-        """Stop audio playback"""
+    async def stop(self):
+        """Stop audio playback and wait for the playback worker to exit"""
         logger.info("Stopping audio player...")
         self.is_playing = False
+        if self._future:
+            await self._future
+            self._future = None
+        # Keep the stream open so a later start() skips the device round-trip
+        if self._stream is not None:
+            self._stream.stop()
+    
+    async def close(self):
+        """Stop playback and release the output stream"""
+        await self.stop()
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+    
+    @staticmethod
+    def invalidate_device_cache():
+        """Forget the cached device list, e.g. after a device is hot-plugged"""
+        _cached_devices.cache_clear()
+        _cached_default_output.cache_clear()
     
     def get_audio_devices(self):
         """Get list of available audio output devices"""
         try:
-            devices = sd.query_devices()
+            devices = _cached_devices()
             output_devices = []
             
             for i, device in enumerate(devices):
@@ -210,7 +401,7 @@ class AudioPlayer:
     def set_device(self, device_id: int):
         """Set audio output device"""
         try:
-            devices = sd.query_devices()
+            devices = _cached_devices()
             if 0 <= device_id < len(devices):
                 device = devices[device_id]
                 if device['max_outputs'] > 0:
@@ -230,11 +421,10 @@ class AudioPlayer:
     def _get_default_output_device(self) -> int:
         """Get the default audio output device ID"""
         try:
-            devices = sd.query_devices()
-            for i, device in enumerate(devices):
-                if device['max_outputs'] > 0:
-                    logger.info(f"Using default audio device: {device['name']} (ID: {i})")
-                    return i
+            i = _cached_default_output()
+            if i is not None:
+                logger.info(f"Using default audio device: {_cached_devices()[i]['name']} (ID: {i})")
+                return i
             return 0  # Fallback to first device
         except Exception as e:
             logger.error(f"Error detecting default audio device: {e}")
@@ -243,7 +433,7 @@ class AudioPlayer:
     def _validate_device(self) -> bool:
         """Validate that the selected audio device is valid"""
         try:
-            devices = sd.query_devices()
+            devices = _cached_devices()
             if 0 <= self.device_id < len(devices):
                 device = devices[self.device_id]
                 if device['max_outputs'] > 0:
@@ -260,9 +450,10 @@ class AudioPlayer:
             return False
 
 # Example usage function
-async def play_audio_track(track: MediaStreamTrack, device_id: Optional[int] = None):
+async def play_audio_track(track: MediaStreamTrack, device_id: Optional[int] = None,
+                           executor: Optional[Executor] = None):
     """Helper function to play an audio track"""
-    player = AudioPlayer(track, device_id)
+    player = AudioPlayer(track, device_id, executor)
     
     try:
         # List available devices
@@ -279,5 +470,5 @@ async def play_audio_track(track: MediaStreamTrack, device_id: Optional[int] = N
     except Exception as e:
         logger.error(f"Error playing audio: {e}")
     finally:
-        player.stop()
+        await player.close()
         logger.info("Audio playback stopped") 
\ No newline at end of file
@@ -1,34 +1,167 @@
 import asyncio
 import logging
+import queue
 import threading
 import time
-from typing import Dict, Optional, Callable
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Callable
 from aiortc.contrib.media import MediaStreamTrack
 import pyaudio
 import numpy as np
 import wave
 import io
 
+from ._audio_kernels import float32_to_int16, mix, mix_q15, q15_scale, to_float32
+
 logger = logging.getLogger(__name__)
 
+# Output formats the mixer can produce
+_SAMPLE_DTYPES = {
+    pyaudio.paInt16: np.int16,
+    pyaudio.paFloat32: np.float32,
+}
+
+# Decoded frame formats the producer reads without going through to_ndarray
+_AV_SAMPLE_DTYPES = {
+    "s16": np.int16, "s16p": np.int16,
+    "flt": np.float32, "fltp": np.float32,
+}
+
+_Q15_ONE = 1 << 15
+
+def _write_view(samples: np.ndarray) -> memoryview:
+    """Read-only byte view of a contiguous array, which PyAudio's write accepts without a copy"""
+    return memoryview(samples).cast('B').toreadonly()
+
+def _to_float32_1d(src: np.ndarray, out: np.ndarray):
+    """to_float32 for a single channel of samples"""
+    to_float32(src.reshape(-1, 1), out.reshape(-1, 1))
+
+def _scratch(buf: np.ndarray, n: int) -> np.ndarray:
+    """Grow a scratch buffer geometrically so it holds at least n samples"""
+    return buf if buf.size >= n else np.empty(max(n, 2 * buf.size), dtype=buf.dtype)
+
+class SampleRing:
+    """
+    Single-producer/single-consumer sample ring shared with the PortAudio callback.
+    The lock only guards the read/write counters; samples are copied outside it.
+    """
+    
+    def __init__(self, capacity: int, dtype=np.float32):
+        self._buf = np.zeros(capacity, dtype=dtype)
+        self._capacity = capacity
+        self._read = 0   # Total samples consumed, only advanced by the callback
+        self._write = 0  # Total samples produced, only advanced by the producer
+        self.overflowed = 0  # Samples the producer could not fit, producer-only
+        self.skipped = 0  # Oldest samples trimmed by the consumer, consumer-only
+        self._lock = threading.Lock()
+    
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+    
+    @property
+    def dtype(self) -> np.dtype:
+        return self._buf.dtype
+    
+    def reset(self):
+        """Discard any buffered samples so the ring can be reused"""
+        with self._lock:
+            self._read = self._write = 0
+        self.overflowed = self.skipped = 0
+    
+    def write(self, samples: np.ndarray) -> int:
+        """Copy as many samples as fit, returning how many were written"""
+        with self._lock:
+            w = self._write
+            free = self._capacity - (w - self._read)
+        n = min(samples.size, free)
+        if n < samples.size:
+            self.overflowed += samples.size - max(n, 0)
+        if n <= 0:
+            return 0
+        start = w % self._capacity
+        first = min(n, self._capacity - start)
+        self._buf[start:start + first] = samples[:first]
+        if n > first:
+            self._buf[:n - first] = samples[first:n]
+        with self._lock:
+            self._write = w + n
+        return n
+    
+    def trim(self, keep: int) -> int:
+        """
+        Drop the oldest samples so at most keep remain, returning how many were
+        dropped. Only the consumer calls this, so it never races the copy in read_into.
+        """
+        with self._lock:
+            excess = self._write - self._read - keep
+            if excess > 0:
+                self._read += excess
+                self.skipped += excess
+                return excess
+        return 0
+    
+    def read_into(self, out: np.ndarray) -> int:
+        """Fill out from the ring, zero-padding on underrun, returning samples read"""
+        with self._lock:
+            r = self._read
+            available = self._write - r
+        n = min(out.size, available)
+        if n > 0:
+            start = r % self._capacity
+            first = min(n, self._capacity - start)
+            out[:first] = self._buf[start:start + first]
+            if n > first:
+                out[first:n] = self._buf[:n - first]
+            with self._lock:
+                self._read = r + n
+        if n < out.size:
+            out[n:] = 0.0
+        return n
+
+@dataclass
+class PeerState:
+    """Everything the player tracks for one peer, behind a single dict lookup"""
+    track: MediaStreamTrack
+    volume: float = 1.0
+    gain_f32: np.float32 = np.float32(1.0)  # volume precomputed for the float32 mixer
+    gain_q15: int = _Q15_ONE  # volume precomputed for the int16 mixer
+    playing: bool = False
+    callback: Optional[Callable] = None
+    task: Optional[asyncio.Task] = None
+    ring: Optional[SampleRing] = None
+    unsupported_frames: int = 0  # Hot-path failures are counted, not logged per frame
+    callback_errors: int = 0
+    
+    def set_volume(self, volume: float):
+        """Clamp and store the volume along with the gains the mixer uses"""
+        self.volume = max(0.0, min(1.0, volume))
+        self.gain_f32 = np.float32(self.volume)
+        self.gain_q15 = round(self.volume * _Q15_ONE)
+
 class LocalAudioPlayer:
     """
     A class to handle real-time audio playback of MediaStreamTracks on the local machine.
     This class manages audio streams from WebRTC connections and plays them locally.
     """
     
-    def __init__(self):
-        self.audio_tracks: Dict[str, MediaStreamTrack] = {}
-        self.audio_streams: Dict[str, pyaudio.PyAudio.Stream] = {}
-        self.is_playing: Dict[str, bool] = {}
-        self.audio_threads: Dict[str, threading.Thread] = {}
-        self.audio_format = pyaudio.paFloat32
+    def __init__(self, max_buffer_ms: int = 100):
+        self._peers: Dict[str, PeerState] = {}
+        self.max_buffer_ms = max_buffer_ms  # Latency bound per peer, older samples are dropped
+        self._ring_pool: queue.SimpleQueue = queue.SimpleQueue()  # Retired rings, refilled by the mixer
+        self.audio_format = pyaudio.paInt16  # Opus decodes to s16, so this avoids a float round-trip
         self.channels = 1
         self.rate = 48000  # Standard WebRTC sample rate
         self.chunk_size = 1024
         self.pyaudio_instance = None
-        self.volume_controls: Dict[str, float] = {}
-        self.audio_callbacks: Dict[str, Callable] = {}
+        self._out_stream = None  # One output stream mixed from every peer's ring
+        self._mix_version = 0  # Bumped whenever a ring is added/removed or a volume changes
+        self._active_version = -1
+        self._known_rings: List[SampleRing] = []  # Every open ring, muted or not, for recycling
+        self._active_rings: List[SampleRing] = []
+        self._active_vols = np.zeros(0, dtype=np.float32)
+        self._active_bufs = np.zeros((0, 0), dtype=np.float32)
         self.audio_available = False
         
         # Initialize PyAudio with better error handling
@@ -44,7 +177,7 @@ class LocalAudioPlayer:
             try:
                 # Try to get default output device info
                 default_output = self.pyaudio_instance.get_default_output_device_info()
-                logger.info(f"Default output device: {default_output['name']}")
+                logger.info("Default output device: %s", default_output['name'])
                 
                 # Test opening a stream
                 test_stream = self.pyaudio_instance.open(
@@ -60,20 +193,18 @@ class LocalAudioPlayer:
                 logger.info("PyAudio initialized successfully and audio output verified")
                 
             except Exception as stream_error:
-                logger.warning(f"Audio stream test failed: {stream_error}")
+                logger.warning("Audio stream test failed: %s", stream_error)
                 # Try alternative audio formats
                 self._try_alternative_audio_formats()
                 
         except Exception as e:
-            logger.error(f"Failed to initialize PyAudio: {e}")
+            logger.error("Failed to initialize PyAudio: %s", e)
             self._try_system_audio_fixes()
     
     def _try_alternative_audio_formats(self):
         """Try alternative audio formats if the default fails"""
         alternative_formats = [
-            pyaudio.paInt16,
-            pyaudio.paInt32,
-            pyaudio.paInt24
+            pyaudio.paFloat32
         ]
         
         for alt_format in alternative_formats:
@@ -89,11 +220,11 @@ class LocalAudioPlayer:
                 
                 self.audio_format = alt_format
                 self.audio_available = True
-                logger.info(f"Audio initialized with alternative format: {alt_format}")
+                logger.info("Audio initialized with alternative format: %s", alt_format)
                 return
                 
             except Exception as e:
-                logger.debug(f"Alternative format {alt_format} failed: {e}")
+                logger.debug("Alternative format %s failed: %s", alt_format, e)
                 continue
         
         logger.error("All audio formats failed, audio playback will not be available")
@@ -123,7 +254,7 @@ class LocalAudioPlayer:
             self.audio_available = True
             logger.info("PyAudio initialized after system fixes")
         except Exception as e:
-            logger.error(f"PyAudio still failed after system fixes: {e}")
+            logger.error("PyAudio still failed after system fixes: %s", e)
             self.audio_available = False
     
     def add_audio_track(self, peer_id: str, track: MediaStreamTrack, volume: float = 1.0) -> bool:
@@ -141,22 +272,22 @@ class LocalAudioPlayer:
         try:
             # Check if audio system is available
             if not self.audio_available:
-                logger.warning(f"Cannot add audio track for peer {peer_id}: Audio system not available")
+                logger.warning("Cannot add audio track for peer %s: Audio system not available", peer_id)
                 return False
             
-            if peer_id in self.audio_tracks:
-                logger.warning(f"Audio track for peer {peer_id} already exists, replacing it")
+            if peer_id in self._peers:
+                logger.warning("Audio track for peer %s already exists, replacing it", peer_id)
                 self.remove_audio_track(peer_id)
             
-            self.audio_tracks[peer_id] = track
-            self.volume_controls[peer_id] = max(0.0, min(1.0, volume))
-            self.is_playing[peer_id] = False
+            state = PeerState(track=track)
+            state.set_volume(volume)
+            self._peers[peer_id] = state
             
-            logger.info(f"Added audio track for peer {peer_id}")
+            logger.info("Added audio track for peer %s", peer_id)
             return True
             
         except Exception as e:
-            logger.error(f"Failed to add audio track for peer {peer_id}: {e}")
+            logger.error("Failed to add audio track for peer %s: %s", peer_id, e)
             return False
     
     def remove_audio_track(self, peer_id: str) -> bool:
@@ -171,24 +302,18 @@ class LocalAudioPlayer:
         """
         try:
             # Stop playback if active
-            if peer_id in self.is_playing and self.is_playing[peer_id]:
+            state = self._peers.get(peer_id)
+            if state is not None and state.playing:
                 self.stop_audio(peer_id)
             
             # Clean up resources
-            if peer_id in self.audio_tracks:
-                del self.audio_tracks[peer_id]
-            if peer_id in self.volume_controls:
-                del self.volume_controls[peer_id]
-            if peer_id in self.is_playing:
-                del self.is_playing[peer_id]
-            if peer_id in self.audio_callbacks:
-                del self.audio_callbacks[peer_id]
-            
-            logger.info(f"Removed audio track for peer {peer_id}")
+            self._peers.pop(peer_id, None)
+            
+            logger.info("Removed audio track for peer %s", peer_id)
             return True
             
         except Exception as e:
-            logger.error(f"Failed to remove audio track for peer {peer_id}: {e}")
+            logger.error("Failed to remove audio track for peer %s: %s", peer_id, e)
             return False
     
     def start_audio(self, peer_id: str) -> bool:
@@ -204,34 +329,33 @@ class LocalAudioPlayer:
         try:
             # Check if audio system is available
             if not self.audio_available:
-                logger.warning(f"Cannot start audio for peer {peer_id}: Audio system not available")
+                logger.warning("Cannot start audio for peer %s: Audio system not available", peer_id)
                 return False
             
-            if peer_id not in self.audio_tracks:
-                logger.error(f"No audio track found for peer {peer_id}")
+            state = self._peers.get(peer_id)
+            if state is None:
+                logger.error("No audio track found for peer %s", peer_id)
                 return False
             
-            if self.is_playing.get(peer_id, False):
-                logger.warning(f"Audio for peer {peer_id} is already playing")
+            if state.playing:
+                logger.warning("Audio for peer %s is already playing", peer_id)
                 return True
             
-            # Create and start audio thread
-            audio_thread = threading.Thread(
-                target=self._audio_playback_worker,
-                args=(peer_id,),
-                daemon=True
-            )
+            self._ensure_out_stream()
             
-            self.audio_threads[peer_id] = audio_thread
-            self.is_playing[peer_id] = True
-            audio_thread.start()
+            # Schedule the producer on the running loop, next to the track
+            state.playing = True
+            state.task = asyncio.get_running_loop().create_task(
+                self._playback_coro(peer_id, state)
+            )
             
-            logger.info(f"Started audio playback for peer {peer_id}")
+            logger.info("Started audio playback for peer %s", peer_id)
             return True
             
         except Exception as e:
-            logger.error(f"Failed to start audio for peer {peer_id}: {e}")
-            self.is_playing[peer_id] = False
+            logger.error("Failed to start audio for peer %s: %s", peer_id, e)
+            if peer_id in self._peers:
+                self._peers[peer_id].playing = False
             return False
     
     def stop_audio(self, peer_id: str) -> bool:
@@ -245,25 +369,23 @@ class LocalAudioPlayer:
             bool: True if audio stopped successfully
         """
         try:
-            if peer_id not in self.is_playing or not self.is_playing[peer_id]:
-                logger.warning(f"Audio for peer {peer_id} is not playing")
+            state = self._peers.get(peer_id)
+            if state is None or not state.playing:
+                logger.warning("Audio for peer %s is not playing", peer_id)
                 return True
             
-            # Stop the audio thread
-            self.is_playing[peer_id] = False
+            # Stop the producer task; it removes its ring from the mix on the way out
+            state.playing = False
             
-            # Wait for thread to finish
-            if peer_id in self.audio_threads:
-                thread = self.audio_threads[peer_id]
-                if thread.is_alive():
-                    thread.join(timeout=1.0)
-                del self.audio_threads[peer_id]
+            task, state.task = state.task, None
+            if task is not None:
+                task.cancel()
             
-            logger.info(f"Stopped audio playback for peer {peer_id}")
+            logger.info("Stopped audio playback for peer %s", peer_id)
             return True
             
         except Exception as e:
-            logger.error(f"Failed to stop audio for peer {peer_id}: {e}")
+            logger.error("Failed to stop audio for peer %s: %s", peer_id, e)
             return False
     
     def set_volume(self, peer_id: str, volume: float) -> bool:
@@ -278,16 +400,18 @@ class LocalAudioPlayer:
             bool: True if volume was set successfully
         """
         try:
-            if peer_id not in self.volume_controls:
-                logger.error(f"No audio track found for peer {peer_id}")
+            state = self._peers.get(peer_id)
+            if state is None:
+                logger.error("No audio track found for peer %s", peer_id)
                 return False
             
-            self.volume_controls[peer_id] = max(0.0, min(1.0, volume))
-            logger.info(f"Set volume for peer {peer_id} to {volume}")
+            state.set_volume(volume)
+            self._mix_version += 1
+            logger.info("Set volume for peer %s to %s", peer_id, volume)
             return True
             
         except Exception as e:
-            logger.error(f"Failed to set volume for peer {peer_id}: {e}")
+            logger.error("Failed to set volume for peer %s: %s", peer_id, e)
             return False
     
     def get_volume(self, peer_id: str) -> Optional[float]:
@@ -300,7 +424,8 @@ class LocalAudioPlayer:
         Returns:
             float: Current volume level, or None if peer not found
         """
-        return self.volume_controls.get(peer_id)
+        state = self._peers.get(peer_id)
+        return state.volume if state is not None else None
     
     def add_audio_callback(self, peer_id: str, callback: Callable) -> bool:
         """
@@ -314,87 +439,278 @@ class LocalAudioPlayer:
             bool: True if callback was added successfully
         """
         try:
-            self.audio_callbacks[peer_id] = callback
-            logger.info(f"Added audio callback for peer {peer_id}")
+            state = self._peers.get(peer_id)
+            if state is None:
+                logger.error("No audio track found for peer %s", peer_id)
+                return False
+            
+            state.callback = callback
+            logger.info("Added audio callback for peer %s", peer_id)
             return True
             
         except Exception as e:
-            logger.error(f"Failed to add audio callback for peer {peer_id}: {e}")
+            logger.error("Failed to add audio callback for peer %s: %s", peer_id, e)
             return False
     
-    def _audio_playback_worker(self, peer_id: str):
+    @property
+    def _sample_dtype(self):
+        return _SAMPLE_DTYPES[self.audio_format]
+    
+    def _ensure_out_stream(self):
+        """Open the single shared output stream on first use"""
+        if self._out_stream is not None:
+            return
+        self._alloc_mix_out(self.chunk_size * self.channels, self._sample_dtype)
+        self._out_stream = self.pyaudio_instance.open(
+            format=self.audio_format,
+            channels=self.channels,
+            rate=self.rate,
+            output=True,
+            frames_per_buffer=self.chunk_size,
+            stream_callback=self._mix_callback
+        )
+        logger.info("Shared audio output stream opened")
+    
+    def _alloc_mix_out(self, size: int, dtype):
+        """Allocate the mixer output and the read-only byte view handed back to PortAudio"""
+        self._mix_out = np.zeros(size, dtype=dtype)
+        self._mix_out_view = _write_view(self._mix_out)
+    
+    def _mix_result(self, needed: int):
+        """Callback result for the first needed samples of the output, without a new buffer"""
+        if needed == self._mix_out.size:
+            return self._mix_out_view, pyaudio.paContinue
+        return self._mix_out_view[:needed * self._mix_out.itemsize], pyaudio.paContinue
+    
+    def _close_out_stream(self):
+        """Stop and close the shared output stream"""
+        stream, self._out_stream = self._out_stream, None
+        if stream is None:
+            return
+        try:
+            stream.stop_stream()
+            stream.close()
+        except Exception as e:
+            logger.debug("Error closing shared audio stream: %s", e)
+    
+    def _mix_callback(self, in_data, frame_count, time_info, status):
+        """
+        PortAudio callback mixing every active ring into one output chunk.
+        It only copies out of the rings, it never waits on the producers.
+        """
+        needed = frame_count * self.channels
+        if needed > self._mix_out.size:
+            self._alloc_mix_out(needed, self._mix_out.dtype)
+        
+        # Rebuild the active ring list, gain vector and (peers, samples) matrix
+        # only when membership or a volume changed
+        width = self._mix_out.size
+        if self._active_version != self._mix_version or self._active_bufs.shape[1] != width:
+            self._active_version = self._mix_version
+            streaming = [state for state in list(self._peers.values()) if state.ring is not None]
+            rings = [state.ring for state in streaming]
+            self._recycle_rings(self._known_rings, rings)
+            self._known_rings = rings
+            # Muted peers are left out of the mix entirely
+            active = [state for state in streaming if state.volume > 0.0]
+            self._active_rings = [state.ring for state in active]
+            if self._mix_out.dtype == np.int16:
+                # Q15 gains, so unity volume is exactly 1 << 15
+                self._active_vols = np.array([state.gain_q15 for state in active], dtype=np.int64)
+            else:
+                self._active_vols = np.array([state.gain_f32 for state in active], dtype=np.float32)
+            self._active_bufs = np.zeros((len(active), width), dtype=self._mix_out.dtype)
+        
+        out = self._mix_out[:needed]
+        
+        if not self._active_rings:
+            out.fill(0)
+            return self._mix_result(needed)
+        
+        # A lone peer is read straight into the output; at unity gain the
+        # decoded samples go out untouched, otherwise they are scaled in place
+        if len(self._active_rings) == 1:
+            ring = self._active_rings[0]
+            ring.trim(self._max_buffered)
+            ring.read_into(out)
+            vol = self._active_vols[0]
+            if out.dtype == np.int16:
+                if vol != _Q15_ONE:
+                    q15_scale(out, vol)
+            elif vol != 1.0:
+                np.multiply(out, vol, out=out)
+            return self._mix_result(needed)
+        
+        bufs = self._active_bufs[:, :needed]
+        for k, ring in enumerate(self._active_rings):
+            ring.trim(self._max_buffered)
+            ring.read_into(bufs[k])
+        if out.dtype == np.int16:
+            mix_q15(out, bufs, self._active_vols)
+        else:
+            mix(out, bufs, self._active_vols)
+            np.clip(out, -1.0, 1.0, out=out)
+        return self._mix_result(needed)
+    
+    @property
+    def _max_buffered(self) -> int:
+        """Samples a ring may hold before the mixer skips ahead to the live edge"""
+        # Never less than one chunk, or every callback would underrun
+        return max(self.rate * self.max_buffer_ms // 1000, self.chunk_size) * self.channels
+    
+    def _ring_capacity(self) -> int:
+        # Headroom over the latency bound so a burst between callbacks is trimmed, not dropped
+        return 2 * self._max_buffered + self.chunk_size * self.channels
+    
+    def _acquire_ring(self) -> SampleRing:
+        """Take a pooled ring if one is free, otherwise allocate"""
+        try:
+            ring = self._ring_pool.get_nowait()
+        except queue.Empty:
+            return SampleRing(self._ring_capacity(), self._sample_dtype)
+        ring.reset()
+        return ring
+    
+    def _recycle_rings(self, old, current):
+        """
+        Return rings the mixer no longer reads to the pool. Runs from the mixer
+        callback, so a ring is only reused once nothing can still be reading it.
+        """
+        capacity = self._ring_capacity()
+        dtype = self._sample_dtype
+        max_pooled = 2 * max(1, len(self._peers))
+        for ring in old:
+            if ring in current:
+                continue
+            # Only standard-size rings are worth keeping
+            if ring.capacity == capacity and ring.dtype == dtype and self._ring_pool.qsize() < max_pooled:
+                self._ring_pool.put(ring)
+    
+    def _make_frame_writer(self, peer_id: str, state: PeerState, ring: SampleRing) -> Callable:
+        """
+        Build the per-frame conversion for one stream. The output format and
+        channel count are fixed while the stream is open, so they are resolved
+        here once and captured as locals instead of being looked up per frame.
+        """
+        sink_dtype = self._sample_dtype
+        mono = self.channels == 1
+        to_sink = float32_to_int16 if sink_dtype == np.int16 else _to_float32_1d
+        ring_write = ring.write
+        
+        # Scratch buffers for the float32 callback path and for format conversion
+        float_scratch = np.empty(self.chunk_size * self.channels, dtype=np.float32)
+        sink_scratch = np.empty(self.chunk_size * self.channels, dtype=sink_dtype)
+        
+        # Source layout, re-derived only when the decoder's format or layout changes
+        last_format = last_layout = None  # Names, PyAV builds fresh format objects per frame
+        src_dtype = None
+        samples_per_frame = 1  # Interleaved samples per audio frame in plane 0
+        stride = 1  # Step that picks the first channel for a mono sink
+        
+        def write_frame(frame):
+            nonlocal float_scratch, sink_scratch
+            nonlocal last_format, last_layout, src_dtype, samples_per_frame, stride
+            # A muted peer's frames are still received, so aiortc's queue drains,
+            # but nothing is converted, processed or mixed
+            if state.volume == 0.0:
+                return
+            fmt = frame.format
+            layout = frame.layout
+            if fmt.name != last_format or layout.name != last_layout:
+                last_format, last_layout = fmt.name, layout.name
+                src_dtype = _AV_SAMPLE_DTYPES.get(fmt.name)
+                samples_per_frame = 1 if fmt.is_planar else len(layout.channels)
+                stride = samples_per_frame if mono else 1
+            if src_dtype is None:
+                # Counted rather than logged per frame; the first one is still reported
+                state.unsupported_frames += 1
+                if state.unsupported_frames == 1:
+                    logger.warning("Unsupported sample format %s from peer %s", fmt.name, peer_id)
+                return
+            
+            # View the frame as a numpy array (frombuffer does not copy, unlike
+            # to_ndarray which vstacks every plane); a mono sink takes the first
+            # channel, like plane 0 of planar audio
+            audio_data = np.frombuffer(
+                frame.planes[0], dtype=src_dtype, count=frame.samples * samples_per_frame
+            )
+            if stride > 1:
+                audio_data = audio_data[::stride]
+            
+            # Apply custom callback if available, promoting to float32 only for it
+            callback = state.callback
+            if callback is not None:
+                if audio_data.dtype != np.float32:
+                    float_scratch = _scratch(float_scratch, audio_data.size)
+                    promoted = float_scratch[:audio_data.size]
+                    _to_float32_1d(audio_data, promoted)
+                    audio_data = promoted
+                try:
+                    audio_data = np.ascontiguousarray(callback(audio_data), dtype=np.float32)
+                except Exception as e:
+                    state.callback_errors += 1
+                    if state.callback_errors == 1:
+                        logger.warning("Audio callback failed for peer %s: %s", peer_id, e)
+            
+            # Convert to the output format if the source differs
+            if audio_data.dtype != sink_dtype:
+                sink_scratch = _scratch(sink_scratch, audio_data.size)
+                converted = sink_scratch[:audio_data.size]
+                to_sink(audio_data, converted)
+                audio_data = converted
+            
+            # Hand the samples to the mixer; what does not fit is counted by the ring
+            ring_write(audio_data)
+        
+        return write_frame
+    
+    async def _playback_coro(self, peer_id: str, state: PeerState):
         """
-        Worker thread for audio playback.
+        Producer coroutine, run on the event loop that owns the track.
         
         Args:
             peer_id: Unique identifier for the peer
+            state: The peer's playback state
         """
+        ring = None
         try:
-            track = self.audio_tracks[peer_id]
-            volume = self.volume_controls[peer_id]
-            
-            # Open audio stream
-            stream = self.pyaudio_instance.open(
-                format=self.audio_format,
-                channels=self.channels,
-                rate=self.rate,
-                output=True,
-                frames_per_buffer=self.chunk_size
-            )
-            
-            self.audio_streams[peer_id] = stream
+            track = state.track
             
-            logger.info(f"Audio stream opened for peer {peer_id}")
+            # The mixer callback pulls from this ring on PortAudio's thread
+            ring = self._acquire_ring()
+            state.ring = ring
+            self._mix_version += 1
+            write_frame = self._make_frame_writer(peer_id, state, ring)
             
-            # Create event loop for async operations
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            try:
-                # Audio playback loop
-                while self.is_playing.get(peer_id, False):
-                    try:
-                        # Read audio data from track using async
-                        frame = loop.run_until_complete(track.recv())
-                        
-                        if frame is None:
-                            break
-                        
-                        # Convert frame to numpy array
-                        audio_data = np.frombuffer(frame.planes[0], dtype=np.float32)
-                        
-                        # Apply volume control
-                        audio_data = audio_data * volume
-                        
-                        # Apply custom callback if available
-                        if peer_id in self.audio_callbacks:
-                            try:
-                                audio_data = self.audio_callbacks[peer_id](audio_data)
-                            except Exception as e:
-                                logger.warning(f"Audio callback failed for peer {peer_id}: {e}")
-                        
-                        # Convert to bytes and play
-                        audio_bytes = audio_data.astype(np.float32).tobytes()
-                        stream.write(audio_bytes)
-                        
-                    except Exception as e:
-                        logger.error(f"Error in audio playback loop for peer {peer_id}: {e}")
+            # Audio playback loop
+            while state.playing:
+                try:
+                    frame = await track.recv()
+                    
+                    if frame is None:
                         break
-            finally:
-                loop.close()
-            
-            # Clean up stream
-            if peer_id in self.audio_streams:
-                stream = self.audio_streams[peer_id]
-                stream.stop_stream()
-                stream.close()
-                del self.audio_streams[peer_id]
+                    
+                    write_frame(frame)
+                    
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("Error in audio playback loop for peer %s: %s", peer_id, e)
+                    break
             
-            logger.info(f"Audio playback worker finished for peer {peer_id}")
+            logger.info("Audio playback worker finished for peer %s", peer_id)
             
+        except asyncio.CancelledError:
+            logger.info("Audio playback cancelled for peer %s", peer_id)
         except Exception as e:
-            logger.error(f"Fatal error in audio playback worker for peer {peer_id}: {e}")
-            self.is_playing[peer_id] = False
+            logger.error("Fatal error in audio playback worker for peer %s: %s", peer_id, e)
+        finally:
+            state.playing = False
+            if ring is not None and state.ring is ring:
+                state.ring = None
+                self._mix_version += 1
+            if state.task is asyncio.current_task():
+                state.task = None
     
     def get_audio_status(self, peer_id: str) -> Dict:
         """
@@ -406,18 +722,24 @@ class LocalAudioPlayer:
         Returns:
             Dict: Status information including playing state, volume, etc.
         """
+        state = self._peers.get(peer_id)
         status = {
             "peer_id": peer_id,
-            "has_track": peer_id in self.audio_tracks,
-            "is_playing": self.is_playing.get(peer_id, False),
-            "volume": self.volume_controls.get(peer_id, 0.0),
-            "has_callback": peer_id in self.audio_callbacks
+            "has_track": state is not None,
+            "is_playing": state is not None and state.playing,
+            "volume": state.volume if state is not None else 0.0,
+            "has_callback": state is not None and state.callback is not None
         }
         
-        if peer_id in self.audio_streams:
-            stream = self.audio_streams[peer_id]
-            status["stream_active"] = stream.is_active()
-            status["stream_stopped"] = stream.is_stopped()
+        if state is not None:
+            status["unsupported_frames"] = state.unsupported_frames
+            status["callback_errors"] = state.callback_errors
+            if state.ring is not None:
+                status["dropped_samples"] = state.ring.overflowed + state.ring.skipped
+        
+        if state is not None and state.ring is not None and self._out_stream is not None:
+            status["stream_active"] = self._out_stream.is_active()
+            status["stream_stopped"] = self._out_stream.is_stopped()
         
         return status
     
@@ -480,7 +802,7 @@ class LocalAudioPlayer:
             Dict: Status information for all peers
         """
         return {peer_id: self.get_audio_status(peer_id) 
-                for peer_id in self.audio_tracks.keys()}
+                for peer_id in self._peers.keys()}
     
     def pause_all_audio(self) -> bool:
         """
@@ -490,15 +812,15 @@ class LocalAudioPlayer:
             bool: True if all audio was paused successfully
         """
         try:
-            for peer_id in list(self.is_playing.keys()):
-                if self.is_playing[peer_id]:
+            for peer_id, state in list(self._peers.items()):
+                if state.playing:
                     self.stop_audio(peer_id)
             
             logger.info("Paused all audio playback")
             return True
             
         except Exception as e:
-            logger.error(f"Failed to pause all audio: {e}")
+            logger.error("Failed to pause all audio: %s", e)
             return False
     
     def resume_all_audio(self) -> bool:
@@ -509,15 +831,15 @@ class LocalAudioPlayer:
             bool: True if all audio was resumed successfully
         """
         try:
-            for peer_id in list(self.audio_tracks.keys()):
-                if not self.is_playing.get(peer_id, False):
+            for peer_id, state in list(self._peers.items()):
+                if not state.playing:
                     self.start_audio(peer_id)
             
             logger.info("Resumed all audio playback")
             return True
             
         except Exception as e:
-            logger.error(f"Failed to resume all audio: {e}")
+            logger.error("Failed to resume all audio: %s", e)
             return False
     
     def cleanup(self):
@@ -528,27 +850,24 @@ class LocalAudioPlayer:
             logger.info("Cleaning up LocalAudioPlayer resources...")
             
             # Stop all audio
-            for peer_id in list(self.is_playing.keys()):
-                if self.is_playing[peer_id]:
+            for peer_id, state in list(self._peers.items()):
+                if state.playing:
                     self.stop_audio(peer_id)
             
+            self._close_out_stream()
+            
             # Close PyAudio
             if self.pyaudio_instance:
                 self.pyaudio_instance.terminate()
                 self.pyaudio_instance = None
             
             # Clear all data structures
-            self.audio_tracks.clear()
-            self.audio_streams.clear()
-            self.is_playing.clear()
-            self.audio_threads.clear()
-            self.volume_controls.clear()
-            self.audio_callbacks.clear()
+            self._peers.clear()
             
             logger.info("LocalAudioPlayer cleanup completed")
             
         except Exception as e:
-            logger.error(f"Error during cleanup: {e}")
+            logger.error("Error during cleanup: %s", e)
     
     def retry_audio_initialization(self) -> bool:
         """
@@ -561,6 +880,7 @@ class LocalAudioPlayer:
         
         try:
             # Clean up existing audio instance
+            self._close_out_stream()
             if self.pyaudio_instance:
                 self.pyaudio_instance.terminate()
                 self.pyaudio_instance = None
@@ -579,7 +899,7 @@ class LocalAudioPlayer:
                 return False
                 
         except Exception as e:
-            logger.error(f"Error during audio reinitialization: {e}")
+            logger.error("Error during audio reinitialization: %s", e)
             return False
     
     def __del__(self):
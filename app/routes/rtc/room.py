@@ -1,41 +1,54 @@
 
 
-from collections import defaultdict
-
 class Rooms: 
     def __init__(self):
-        self._peers = defaultdict(set)  # room_id -> set(peer_id)
+        # Copy-on-write: each room's member set is replaced, never mutated, so
+        # iterating a snapshot is safe while peers join and leave
+        self._peers = {}  # room_id -> frozenset(peer_id)
         self._peer_rooms = {}  # peer_id -> room_id
+        self._neighbors = {}  # peer_id -> frozenset of the other peers in its room
+
+    def _remove_from_room(self, room_id: str, peer_id: str):
+        members = self._peers.get(room_id)
+        if members is not None:
+            members = members - {peer_id}
+            for other in members:
+                self._neighbors[other] = self._neighbors[other] - {peer_id}
+            if members:
+                self._peers[room_id] = members
+            else:
+                self._peers.pop(room_id, None)
+        self._neighbors.pop(peer_id, None)
 
     def join(self, room_id: str, peer_id: str):
         # Remove peer from previous room if any
-        if peer_id in self._peer_rooms:
-            old_room = self._peer_rooms[peer_id]
-            if old_room in self._peers:
-                self._peers[old_room].discard(peer_id)
-                if not self._peers[old_room]:
-                    self._peers.pop(old_room, None)
+        previous = self._peer_rooms.get(peer_id)
+        if previous is not None:
+            self._remove_from_room(previous, peer_id)
         
-        # Add peer to new room
-        self._peers[room_id].add(peer_id)
+        # Add peer to new room, updating only the neighbor sets it touches
+        members = self._peers.get(room_id, frozenset())
+        for other in members:
+            self._neighbors[other] = self._neighbors[other] | {peer_id}
+        self._neighbors[peer_id] = members
+        self._peers[room_id] = members | {peer_id}
         self._peer_rooms[peer_id] = room_id
 
     def leave(self, peer_id: str):
         """Remove a peer from their current room"""
-        if peer_id in self._peer_rooms:
-            room_id = self._peer_rooms[peer_id]
-            if room_id in self._peers:
-                self._peers[room_id].discard(peer_id)
-                if not self._peers[room_id]:
-                    self._peers.pop(room_id, None)
-            del self._peer_rooms[peer_id]
+        room_id = self._peer_rooms.pop(peer_id, None)
+        if room_id is not None:
+            self._remove_from_room(room_id, peer_id)
 
     def others(self, room_id: str, peer_id: str):
-        return [p for p in self._peers[room_id] if p != peer_id]
+        """Peers sharing room_id with peer_id, served from the neighbor cache"""
+        if self._peer_rooms.get(peer_id) == room_id:
+            return self._neighbors[peer_id]
+        return self._peers.get(room_id, frozenset()) - {peer_id}
     
     def get_peers_in_room(self, room_id: str):
-        """Get all peer IDs in a specific room"""
-        return self._peers.get(room_id, set())
+        """Get an immutable snapshot of the peer IDs in a specific room"""
+        return self._peers.get(room_id, frozenset())
     
     def get_peer_room(self, peer_id: str):
         """Get the room ID for a specific peer"""
@@ -2,63 +2,133 @@
 import asyncio
 import json
 import logging
+import time
 from threading import local
-from aiortc import RTCPeerConnection, RTCSessionDescription, RTCIceCandidate, RTCConfiguration, RTCIceServer
+from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer, RTCRtpSender
 from aiortc.contrib.media import MediaStreamTrack, MediaPlayer, MediaRecorder, MediaRelay
-from typing import Dict, Set, Optional
+from aiortc.sdp import candidate_from_sdp
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Set, Optional
 from .room import Rooms
 from .audio_handler import AudioStreamHandler, initialize_audio_processors
+from .audio_mixer import AudioMixerTrack
 import sounddevice as sd
 from av import AudioFrame
 import numpy as np
-from collections import deque
 logger = logging.getLogger(__name__)
 
+# One ICE server entry listing every STUN URL; the configuration is
+# immutable, so every peer connection shares it
+_DEFAULT_RTC_CONFIG = RTCConfiguration([
+    RTCIceServer(urls=[
+        "stun:stun.l.google.com:19302",
+        "stun:stun1.l.google.com:19302",
+        "stun:stun2.l.google.com:19302",
+        "stun:stun3.l.google.com:19302",
+        "stun:stun4.l.google.com:19302",
+        "stun:stun.stunprotocol.org:3478",
+        "stun:stun1.opentelecom.ro:3478",
+    ]),
+])
+_NEGOTIATION_DEBOUNCE = 0.01  # seconds of addTrack calls folded into one renegotiation
+# How long a renegotiation waits for the peer to answer the previous offer
+_NEGOTIATION_TIMEOUT = 30.0
+# Fanout senders only offer Opus, the codec browsers send us, so listeners
+# never negotiate a lossier G.711 re-encode
+_OPUS_CODECS = [c for c in RTCRtpSender.getCapabilities("audio").codecs if c.mimeType.lower() == "audio/opus"]
+
+async def wait_for_state(pc: RTCPeerConnection, attr: str, pred, event_name: str, timeout: Optional[float] = None):
+    """Wait until pred(getattr(pc, attr)) holds, woken by pc's event_name instead of polling.
+    e.g. wait_for_state(pc, "connectionState", lambda s: s == "connected", "connectionstatechange", 10)"""
+    if pred(getattr(pc, attr)):
+        return
+    ev = asyncio.Event()
+    
+    def _check():
+        if pred(getattr(pc, attr)):
+            ev.set()
+    
+    pc.on(event_name, _check)
+    try:
+        # Re-check after subscribing so a transition in between isn't missed
+        _check()
+        await asyncio.wait_for(ev.wait(), timeout)
+    finally:
+        pc.remove_listener(event_name, _check)
+
+@dataclass(slots=True)
+class PeerState:
+    """Everything the handler tracks for one peer, in one record instead of parallel dicts"""
+    pc: RTCPeerConnection
+    track: Optional[MediaStreamTrack] = None  # relayed incoming audio
+    remote_track: Optional[MediaStreamTrack] = None  # incoming audio before relaying
+    fanout_source: Optional[MediaStreamTrack] = None  # track this peer's listeners subscribe from
+    senders: Dict[str, RTCRtpSender] = field(default_factory=dict)  # source peer -> sender on this pc
+    negotiation: Optional[asyncio.TimerHandle] = None  # scheduled renegotiation
+    negotiating: bool = False  # an offer is being prepared or waits for stable
+    renegotiate: bool = False  # tracks were added after that offer was created
+
 class WebRTCHandler : 
-    def __init__(self):
+    def __init__(self, signal: Optional[Callable[[str, dict], Awaitable[None]]] = None):
+        """signal(peer_id, message) sends a signaling message to a peer; without it
+        the server cannot renegotiate after adding tracks"""
+        self.signal = signal
         self.room = Rooms()
-        self.connections: Dict[str, RTCPeerConnection] = {}
-        self.audio_tracks: Dict[str, MediaStreamTrack] = {}
+        self.peers: Dict[str, PeerState] = {}
         self.audio_handler = AudioStreamHandler()
         self.media_relay = MediaRelay()  # For forwarding media between peers
+        self._pending_fanout: Dict[str, Set[str]] = {}  # room -> listeners still waiting to connect
+        self._audio_peers: Set[str] = set()  # peers whose PeerState.track is set
+        self._closing: Set[asyncio.Task] = set()  # background pc.close() tasks, kept alive until done
+        self._room_recorders: Dict[str, MediaRecorder] = {}
+        self._room_mixers: Dict[str, AudioMixerTrack] = {}
+        self._negotiating: Set[asyncio.Task] = set()
         
         # Initialize default audio processors
         initialize_audio_processors(self.audio_handler)
+        
+        # Fanout and signaling throughput depends heavily on the loop, so
+        # make the backend visible (uvloop unless USE_UVLOOP=0)
+        try:
+            loop_type = type(asyncio.get_running_loop())
+        except RuntimeError:
+            loop_type = type(asyncio.get_event_loop_policy())
+        logger.info(f"WebRTC handler running on {loop_type.__module__}.{loop_type.__qualname__}")
 
     async def create_peer_connection(self, room_id: str, peer_id: str) -> RTCPeerConnection:
         
-        config = RTCConfiguration([
-            RTCIceServer(urls="stun:stun.l.google.com:19302"),
-            RTCIceServer(urls="stun:stun1.l.google.com:19302"),
-            RTCIceServer(urls="stun:stun2.l.google.com:19302"),
-            RTCIceServer(urls="stun:stun3.l.google.com:19302"),
-            RTCIceServer(urls="stun:stun4.l.google.com:19302"),
-            RTCIceServer(urls="stun:stun.stunprotocol.org:3478"),
-            RTCIceServer(urls="stun:stun1.opentelecom.ro:3478"),
-        ])
+        logger.debug("Creating RTCPeerConnection with ICE configuration: %s", _DEFAULT_RTC_CONFIG)
         
-        logger.info(f"Creating RTCPeerConnection with ICE configuration: {config}")
-        
-        pc = RTCPeerConnection(config)
-        self.connections[peer_id] = pc
+        pc = RTCPeerConnection(_DEFAULT_RTC_CONFIG)
+        state = self.peers[peer_id] = PeerState(pc)
+        self._audio_peers.discard(peer_id)
 
         # Set up audio track handling
         @pc.on("track")
         async def on_track(track):
-            print(f"=== ONTRACK EVENT TRIGGERED ===")
-            print(f"Received {track.kind} track from peer {peer_id}")
-            print(f"Track ID: {track.id}, Track kind: {track.kind}")
-            print(f"Peer connection state: {pc.connectionState}")
-            print(f"ICE connection state: {pc.iceConnectionState}")
+            logger.debug("ONTRACK %s track %s from %s state=%s ice=%s",
+                         track.kind, track.id, peer_id, pc.connectionState, pc.iceConnectionState)
             
             if track.kind == "audio":
                 try:
                     # Use media relay to create a relayed track that can be shared
                     relayed_track = self.media_relay.subscribe(track)
-                    self.audio_tracks[peer_id] = relayed_track
+                    state.track = relayed_track
+                    if self.peers.get(peer_id) is state:
+                        self._audio_peers.add(peer_id)
+                    state.remote_track = track
+                    
+                    # Join the room's mixed recording if one is running
+                    mixer = self._room_mixers.get(self.room.get_peer_room(peer_id))
+                    if mixer is not None:
+                        mixer.add_source(peer_id, self.media_relay.subscribe(track, buffered=False))
                     
-                    # Process the audio track with error handling
-                    processed_track = await self.audio_handler.process_audio_track(peer_id, relayed_track)
+                    # Process the audio track with error handling; with only the
+                    # passthrough processor the relayed track is used as is
+                    if self.audio_handler.has_active_processors(peer_id):
+                        processed_track = await self.audio_handler.process_audio_track(peer_id, relayed_track)
+                    else:
+                        processed_track = relayed_track
                     
                     # Ensure we have a valid track before proceeding
                     if processed_track is not None:
@@ -76,7 +146,7 @@ class WebRTCHandler :
                     except Exception as fallback_error:
                         logger.error(f"Fallback audio handling also failed for peer {peer_id}: {fallback_error}")
             else:
-                print(f"Unsupported track type: {track.kind}")
+                logger.warning("Unsupported track type: %s", track.kind)
 
         self.room.join(room_id, peer_id)
         return pc
@@ -86,26 +156,24 @@ class WebRTCHandler :
         logger.info(f"Setting up audio track handling for peer {peer_id}")
         
         # Update audio statistics
-        self.audio_handler.update_audio_stats(peer_id, {
-            "track_active": True,
-            "track_type": "audio",
-            "timestamp": asyncio.get_event_loop().time()
-        })
+        stats = self.audio_handler.get_or_create(peer_id)
+        stats.track_active = True
+        stats.track_type = "audio"
+        stats.timestamp = time.monotonic()
         
         # Get room information for logging
         room_id = self.room.get_peer_room(peer_id)
         room_peers = self.room.get_peers_in_room(room_id) if room_id else set()
-        other_peers_count = len([p for p in room_peers if p != peer_id])
+        other_peers_count = len(room_peers) - (peer_id in room_peers)
         
         logger.info(f"Peer {peer_id} in room {room_id} with {other_peers_count} other peers")
-        print(f"Peer {peer_id} in room {room_id} with {other_peers_count} other peers")
         # Create local audio player for testing
         local_player = AudioPlayerTrack(track)
         local_player.start()
         # logger.info(f"Created AudioPlayerTrack for peer {peer_id}")
         
         # # Forward the audio track to other peers in the same room
-        # await self.forward_audio_track_to_room(peer_id, track)
+        # await self.forward_audio_track_to_room(peer_id, track, room_id)
         
         # logger.info(f"Audio track from peer {peer_id} is now active and processed")
         
@@ -117,8 +185,10 @@ class WebRTCHandler :
 
 
 
-    async def forward_audio_track_to_room(self, source_peer_id: str, track: MediaStreamTrack):
-        """Forward audio track to all other peers in the same room"""
+    async def forward_audio_track_to_room(self, source_peer_id: str, track: MediaStreamTrack,
+                                          room_id: Optional[str] = None):
+        """Forward audio track to all other peers in the same room.
+        Pass room_id when the caller already looked it up to skip a second lookup."""
         try:
             # Validate input parameters
             if not track or not hasattr(track, 'kind'):
@@ -130,54 +200,183 @@ class WebRTCHandler :
                 return
             
             # Get the room ID for this peer
-            room_id = self.room.get_peer_room(source_peer_id)
+            if room_id is None:
+                room_id = self.room.get_peer_room(source_peer_id)
             if not room_id:
                 logger.warning(f"Peer {source_peer_id} not in any room")
                 return
             
-            # Get all other peers in the same room (excluding the source peer)
-            room_peers = self.room.get_peers_in_room(room_id)
-            other_peers = [peer_id for peer_id in room_peers if peer_id != source_peer_id]
+            # A speaker alone in the room (the usual case while a call starts)
+            # has nobody to forward to
+            if len(self.room.get_peers_in_room(room_id)) < 2:
+                logger.debug("Peer %s is alone in room %s, nothing to forward", source_peer_id, room_id)
+                return
+            
+            # Get all other peers in the same room (excluding the source peer),
+            # straight from the room's cached neighbor set
+            other_peers = self.room.others(room_id, source_peer_id)
             
             if not other_peers:
-                logger.info(f"No other peers in room {room_id} to forward audio to")
+                logger.debug("No other peers in room %s to forward audio to", room_id)
                 return
             
             logger.info(f"Forwarding audio track from {source_peer_id} to {len(other_peers)} other peers in room {room_id}")
             
-            # Forward audio track to all other peers using media relay
-            successful_forwards = 0
+            source = self.peers.get(source_peer_id)
+            if source is None:
+                logger.warning(f"Peer {source_peer_id} has no connection, not forwarding its audio")
+                return
+            
+            # One fanout source per speaker; a new track from the same speaker
+            # replaces it on the existing senders instead of adding more
+            replaced = source.fanout_source is not track
+            source.fanout_source = track
+            
+            # Only connected listeners can take the track now; the rest are
+            # parked per room and picked up once their connection comes up
+            ready = []
             for peer_id in other_peers:
-                if peer_id in self.connections:
-                    try:
-                        pc = self.connections[peer_id]
-                        if pc.connectionState == "connected":
-                            # Create a relayed track for this peer
-                            relayed_track = self.media_relay.subscribe(track)
-                            # Add the relayed track to the peer's connection
-                            sender = pc.addTrack(relayed_track)
-                            successful_forwards += 1
-                            logger.info(f"Successfully forwarded audio track from {source_peer_id} to {peer_id}")
-                        else:
-                            logger.warning(f"Peer {peer_id} connection not ready (state: {pc.connectionState})")
-                    except Exception as e:
-                        logger.error(f"Failed to forward audio track to {peer_id}: {e}")
-                else:
+                listener = self.peers.get(peer_id)
+                if listener is None:
                     logger.warning(f"Peer {peer_id} not found in connections, skipping audio forwarding")
+                elif listener.pc.connectionState == "connected":
+                    ready.append((peer_id, listener))
+                else:
+                    logger.debug("Peer %s not connected yet (state: %s), deferring audio forwarding",
+                                 peer_id, listener.pc.connectionState)
+                    self._pending_fanout.setdefault(room_id, set()).add(peer_id)
+            
+            # Forward audio track to all ready peers concurrently using media relay
+            results = await asyncio.gather(
+                *(self._forward_to_listener(source_peer_id, track, peer_id, listener, replaced)
+                  for peer_id, listener in ready),
+                return_exceptions=True,
+            )
+            successful_forwards = sum(1 for result in results if result is True)
             
-            logger.info(f"Audio forwarding completed: {successful_forwards}/{len(other_peers)} peers received the track")
+            logger.info(f"Audio forwarding completed: {successful_forwards}/{len(ready)} connected peers received the track")
                         
         except Exception as e:
             logger.error(f"Error forwarding audio track: {e}")
             import traceback
             logger.error(f"Traceback: {traceback.format_exc()}")
 
+    async def _forward_to_listener(self, source_peer_id: str, track: MediaStreamTrack, peer_id: str,
+                                   listener: PeerState, replaced: bool = False) -> bool:
+        """Forward a speaker's track to one connected listener, returning whether it now receives it"""
+        try:
+            senders = listener.senders
+            sender = senders.get(source_peer_id)
+            if sender is not None and not replaced:
+                # Already listening to this source
+                return True
+            # Each listener needs its own relay proxy: a relayed track is a
+            # single-consumer queue in aiortc. Unbuffered proxies only hold
+            # the latest frame, so a slow listener drops audio instead of
+            # queueing latency and memory.
+            relayed_track = self.media_relay.subscribe(track, buffered=False)
+            if sender is not None:
+                sender.replaceTrack(relayed_track)
+            else:
+                # Add the relayed track to the peer's connection; replaceTrack
+                # above needs no renegotiation, a new sender does
+                sender = senders[source_peer_id] = listener.pc.addTrack(relayed_track)
+                for transceiver in listener.pc.getTransceivers():
+                    if transceiver.sender is sender:
+                        transceiver.setCodecPreferences(_OPUS_CODECS)
+                        break
+                self._schedule_negotiation(peer_id)
+            logger.info(f"Successfully forwarded audio track from {source_peer_id} to {peer_id}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to forward audio track to {peer_id}: {e}")
+            return False
+
+    async def _flush_pending_fanout(self, peer_id: str):
+        """Hand a newly connected listener the tracks it was deferred from"""
+        room_id = self.room.get_peer_room(peer_id)
+        pending = self._pending_fanout.get(room_id)
+        if not pending or peer_id not in pending:
+            return
+        pending.discard(peer_id)
+        if not pending:
+            del self._pending_fanout[room_id]
+        
+        listener = self.peers.get(peer_id)
+        if listener is None:
+            return
+        sources = []
+        for source_peer_id in self.room.others(room_id, peer_id):
+            source = self.peers.get(source_peer_id)
+            if source is not None and source.fanout_source is not None:
+                sources.append((source_peer_id, source.fanout_source))
+        await asyncio.gather(
+            *(self._forward_to_listener(source_peer_id, track, peer_id, listener) for source_peer_id, track in sources),
+            return_exceptions=True,
+        )
+        logger.info(f"Flushed {len(sources)} deferred audio tracks to peer {peer_id}")
+
+    def _schedule_negotiation(self, peer_id: str):
+        """Coalesce the addTrack calls of the current burst into one offer to the peer"""
+        state = self.peers.get(peer_id)
+        if state is None:
+            return
+        if state.negotiation is not None:
+            state.negotiation.cancel()
+        state.negotiation = asyncio.get_running_loop().call_later(
+            _NEGOTIATION_DEBOUNCE, self._do_negotiate, peer_id)
+
+    def _do_negotiate(self, peer_id: str):
+        state = self.peers.get(peer_id)
+        if state is not None:
+            state.negotiation = None
+        task = asyncio.get_running_loop().create_task(self._negotiate(peer_id))
+        self._negotiating.add(task)
+        task.add_done_callback(self._negotiating.discard)
+
+    async def _negotiate(self, peer_id: str):
+        """Send the peer a single offer covering every track added since the last one"""
+        state = self.peers.get(peer_id)
+        if state is None or self.signal is None:
+            return
+        if state.negotiating:
+            # Fold into the offer being prepared, or follow it once it is sent
+            state.renegotiate = True
+            return
+        state.negotiating = True
+        pc = state.pc
+        try:
+            # An offer/answer exchange may be in flight; wait for it to settle
+            await wait_for_state(pc, "signalingState", lambda s: s in ("stable", "closed"),
+                                 "signalingstatechange", _NEGOTIATION_TIMEOUT)
+            if pc.signalingState == "closed":
+                return
+            # The offer below covers every track added up to this point
+            state.renegotiate = False
+            await pc.setLocalDescription(await pc.createOffer())
+            await self.signal(peer_id, {
+                "type": "offer",
+                "roomId": self.room.get_peer_room(peer_id),
+                "offer": {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type},
+            })
+            logger.debug("Sent renegotiation offer to peer %s", peer_id)
+        except asyncio.TimeoutError:
+            logger.warning(f"Peer {peer_id} never answered the previous offer, skipping renegotiation")
+            state.renegotiate = False
+        except Exception as e:
+            logger.error(f"Renegotiation with peer {peer_id} failed: {e}")
+        finally:
+            state.negotiating = False
+            if state.renegotiate and self.peers.get(peer_id) is state:
+                state.renegotiate = False
+                self._schedule_negotiation(peer_id)
+
     async def add_audio_track(self, peer_id: str, audio_source: Optional[str] = None):
         """Add an audio track to the peer connection"""
-        if peer_id not in self.connections:
+        state = self.peers.get(peer_id)
+        if state is None:
             raise ValueError(f"No connection found for peer {peer_id}")
-        
-        pc = self.connections[peer_id]
+        pc = state.pc
         
         if audio_source:
             # Create a media player from an audio file or stream
@@ -204,53 +403,72 @@ class WebRTCHandler :
         """Stop recording audio from a specific peer"""
         return await self.audio_handler.stop_recording(peer_id)
     
+    async def start_room_recording(self, room_id: str, filename: str) -> bool:
+        """Record one mix of every peer in a room, instead of a recorder per peer"""
+        if room_id in self._room_recorders:
+            logger.warning(f"Recording already active for room {room_id}")
+            return False
+        try:
+            mixer = AudioMixerTrack()
+            for peer_id in self.room.get_peers_in_room(room_id):
+                state = self.peers.get(peer_id)
+                if state is not None and state.remote_track is not None:
+                    mixer.add_source(peer_id, self.media_relay.subscribe(state.remote_track, buffered=False))
+            
+            recorder = MediaRecorder(filename)
+            recorder.addTrack(mixer)
+            await recorder.start()
+            self._room_recorders[room_id] = recorder
+            self._room_mixers[room_id] = mixer
+            logger.info(f"Started mixed recording of room {room_id} ({mixer.source_count} peers) to {filename}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to start recording for room {room_id}: {e}")
+            return False
+    
+    async def stop_room_recording(self, room_id: str) -> bool:
+        """Stop a room's mixed recording"""
+        recorder = self._room_recorders.pop(room_id, None)
+        mixer = self._room_mixers.pop(room_id, None)
+        if recorder is None:
+            logger.warning(f"No active recording for room {room_id}")
+            return False
+        try:
+            await recorder.stop()
+            logger.info(f"Stopped recording for room {room_id}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to stop recording for room {room_id}: {e}")
+            return False
+        finally:
+            mixer.stop()
+    
     def get_audio_statistics(self, peer_id: str) -> Dict:
         """Get audio statistics for a specific peer"""
         return self.audio_handler.get_audio_stats(peer_id)
     
     def get_all_audio_statistics(self) -> Dict[str, Dict]:
         """Get audio statistics for all peers"""
-        return self.audio_handler.audio_stats
+        return self.audio_handler.get_all_audio_stats()
 
     async def handle_offer(self, room_id: str, peer_id: str, offer: dict):
-        print("handle_offer", room_id, peer_id, offer)
+        logger.debug("handle_offer room=%s peer=%s sdp_len=%d", room_id, peer_id, len(offer.get("sdp") or ""))
         pc = await self.create_peer_connection(room_id, peer_id)
         
-        # Set up ICE candidate collection BEFORE setting local description
-        ice_candidates = []
-        ice_gathering_started = asyncio.Event()
-        ice_gathering_complete = asyncio.Event()
-        
-        @pc.on("icecandidate")
-        def on_ice_candidate(candidate):
-            ice_gathering_started.set()
-            if candidate:
-                logger.info(f"ICE candidate generated for peer {peer_id}: {candidate.candidate}")
-                logger.info(f"ICE candidate details - sdpMid: {candidate.sdpMid}, sdpMLineIndex: {candidate.sdpMLineIndex}")
-                ice_candidates.append({
-                    "candidate": candidate.candidate,
-                    "sdpMid": candidate.sdpMid,
-                    "sdpMLineIndex": candidate.sdpMLineIndex
-                })
-            else:
-                logger.info(f"ICE candidate generation completed for peer {peer_id}")
-                ice_gathering_complete.set()
-        
         @pc.on("connectionstatechange")
-        def on_connection_state_change():
+        async def on_connection_state_change():
             logger.info(f"Connection state changed for peer {peer_id}: {pc.connectionState}")
+            if pc.connectionState == "connected":
+                await self._flush_pending_fanout(peer_id)
     
         @pc.on("iceconnectionstatechange") 
         def on_ice_connection_state_change():
-            print(f"ICE connection state changed for peer {peer_id}: {pc.iceConnectionState}")
+            logger.debug("ICE connection state changed for peer %s: %s", peer_id, pc.iceConnectionState)
     
         # Also monitor ICE gathering state changes
         @pc.on("icegatheringstatechange")
         def on_ice_gathering_state_change():
-            logger.info(f"ICE gathering state changed for peer {peer_id}: {pc.iceGatheringState}")
-            if pc.iceGatheringState == "complete":
-                logger.info(f"ICE gathering completed via state change for peer {peer_id}")
-                ice_gathering_complete.set()
+            logger.debug("ICE gathering state changed for peer %s: %s", peer_id, pc.iceGatheringState)
         
         await pc.setRemoteDescription(
             RTCSessionDescription(
@@ -260,156 +478,128 @@ class WebRTCHandler :
         )
 
         answer = await pc.createAnswer()
-        print(f"Created answer for peer {peer_id}, SDP: {answer.sdp[:200]}...")
+        logger.debug("Created answer for peer %s, SDP: %.200s...", peer_id, answer.sdp)
         
-        # ICE gathering starts here when we set local description
+        # aiortc gathers every local candidate inside setLocalDescription and
+        # never emits icecandidate, so the answer goes back as soon as it returns
         await pc.setLocalDescription(answer)
-        print(f"Set local description for peer {peer_id}")
-        
-        print(f"Waiting for ICE gathering to complete for peer {peer_id}")
-        print(f"Current ICE gathering state: {pc.iceGatheringState}")
-        print(f"Current connection state: {pc.connectionState}")
-        print(f"Current ICE connection state: {pc.iceConnectionState}")
-        
-        # Wait for ICE gathering to complete with timeout
-        try:
-            await asyncio.wait_for(ice_gathering_complete.wait(), timeout=15.0)  # 30 second timeout
-            logger.info(f"ICE gathering completed for peer {peer_id}")
-        except asyncio.TimeoutError:
-            logger.warning(f"ICE gathering timeout for peer {peer_id}, proceeding with {len(ice_candidates)} candidates")
-            logger.warning(f"ICE gathering state at timeout: {pc.iceGatheringState}")
-        
-        # Also check the gathering state
-        logger.info(f"Final ICE gathering state: {pc.iceGatheringState}")
-        logger.info(f"Total ICE candidates collected: {len(ice_candidates)}")
-        
-        # Log all collected candidates for debugging
-        for i, candidate in enumerate(ice_candidates):
-            logger.info(f"ICE Candidate {i+1}: {candidate}")
+        logger.debug("Set local description for peer %s gathering=%s state=%s ice=%s",
+                     peer_id, pc.iceGatheringState, pc.connectionState, pc.iceConnectionState)
 
+        # Local candidates are embedded in the local description's SDP; the
+        # client's own candidates keep trickling in through handle_candidate
         return {
             "sdp": pc.localDescription.sdp,
             "type": pc.localDescription.type,
-            "ice_candidates": ice_candidates
+            "ice_candidates": []
         }
     
     async def handle_answer(self, user_id: str, answer: dict):
         """Handle WebRTC answer"""
-        logger.info(f"=== HANDLE ANSWER CALLED ===")
-        logger.info(f"User ID: {user_id}")
-        logger.info(f"Answer: {answer}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("handle_answer user=%s sdp_len=%d", user_id, len(answer.get("sdp") or ""))
         
-        if user_id not in self.connections:
+        state = self.peers.get(user_id)
+        if state is None:
             logger.error(f"No connection found for user {user_id}")
             raise ValueError(f"No connection found for user {user_id}")
-        
-        pc = self.connections[user_id]
-        logger.info(f"Found peer connection for user {user_id}")
-        logger.info(f"Connection state: {pc.connectionState}")
-        logger.info(f"ICE connection state: {pc.iceConnectionState}")
+        pc = state.pc
         
         await pc.setRemoteDescription(RTCSessionDescription(
             sdp=answer["sdp"],
             type=answer["type"]
         ))
         
-        logger.info(f"Remote description set successfully for user {user_id}")
-        logger.info(f"Updated connection state: {pc.connectionState}")
-        logger.info(f"Updated ICE connection state: {pc.iceConnectionState}")
+        logger.info("Answer set for %s (state=%s ice=%s)", user_id, pc.connectionState, pc.iceConnectionState)
 
     async def handle_candidate(self, room_id: str, peer_id: str, candidate: dict):
-        print("handle_candidate", room_id, peer_id, candidate)
-        if peer_id not in self.connections:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("handle_candidate room=%s peer=%s candidate=%s", room_id, peer_id, candidate)
+        state = self.peers.get(peer_id)
+        if state is None:
             raise ValueError(f"No connection found for user {peer_id}")
-        
-        pc = self.connections[peer_id]
+        pc = state.pc
         
         try:
             # Parse the ICE candidate string to extract required parameters
-            candidate_str = candidate["candidate"]
+            candidate_str = candidate.get("candidate")
             
-            # Parse candidate string format: "candidate:1 1 UDP 2122252543 192.168.1.1 54321 typ host"
-            # Format: foundation priority protocol priority2 ip port typ type [relatedAddress] [relatedPort] [tcpType]
-            parts = candidate_str.split()
+            # An empty candidate is the client's end-of-candidates marker for trickle ICE
+            if not candidate_str:
+                logger.info(f"End of remote ICE candidates for peer {peer_id}")
+                return
             
-            if len(parts) < 8:
+            # aiortc's own SDP parser takes the attribute value without the
+            # "a=" / "candidate:" prefixes
+            try:
+                ice_candidate = candidate_from_sdp(candidate_str.removeprefix("a=").removeprefix("candidate:"))
+            except (IndexError, ValueError):
                 logger.error(f"Invalid ICE candidate format: {candidate_str}")
                 return
-            
-            # Extract parameters from the candidate string
-            foundation = parts[0]  # "candidate:1"
-            priority = int(parts[1])  # First priority
-            protocol = parts[2]  # "UDP"
-            # parts[3] is another priority value, we'll use the first one
-            ip = parts[4]  # IP address
-            port = int(parts[5])  # Port
-            # parts[6] is "typ"
-            candidate_type = parts[7]  # Actual type (e.g., "host")
-            
-            # Default values for optional parameters
-            related_address = None
-            related_port = None
-            tcp_type = None
-            
-            # Check for related address/port and tcp type (if more parts exist)
-            for i in range(8, len(parts), 2):
-                if i + 1 < len(parts):
-                    if parts[i] == "raddr":
-                        related_address = parts[i + 1]
-                    elif parts[i] == "rport":
-                        related_port = int(parts[i + 1])
-                    elif parts[i] == "tcptype":
-                        tcp_type = parts[i + 1]
-            
-            # Create RTCIceCandidate with the correct parameter format
-            ice_candidate = RTCIceCandidate(
-                component=1,  # Default to 1 for RTP
-                foundation=foundation,
-                ip=ip,
-                port=port,
-                priority=priority,
-                protocol=protocol,
-                type=candidate_type,
-                relatedAddress=related_address,
-                relatedPort=related_port,
-                sdpMid=candidate.get("sdpMid"),
-                sdpMLineIndex=candidate.get("sdpMLineIndex"),
-                tcpType=tcp_type
-            )
+            ice_candidate.sdpMid = candidate.get("sdpMid")
+            ice_candidate.sdpMLineIndex = candidate.get("sdpMLineIndex")
             
             await pc.addIceCandidate(ice_candidate)
-            logger.info(f"Successfully added ICE candidate for peer {peer_id}")
+            logger.debug("Added ICE candidate for peer %s", peer_id)
             
         except Exception as e:
-            logger.error(f"Error adding ICE candidate for peer {peer_id}: {e}")
-            logger.error(f"Candidate data received: {candidate}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
+            # The dump is only built on this failure path
+            logger.exception("Error adding ICE candidate for peer %s: %s (candidate: %r)", peer_id, e, candidate)
             raise
 
     async def remove_peer(self, peer_id: str):
         """Clean up peer connection and associated resources"""
-        if peer_id in self.connections:
-            pc = self.connections[peer_id]
-            await pc.close()
-            del self.connections[peer_id]
-            
-        if peer_id in self.audio_tracks:
-            del self.audio_tracks[peer_id]
-            
-        # Stop any active recordings
-        await self.audio_handler.stop_recording(peer_id)
-        
+        # Drop the bookkeeping first so nothing new targets the dying connection,
+        # then let ICE/DTLS teardown finish in the background
+        state = self.peers.pop(peer_id, None)
+        self._audio_peers.discard(peer_id)
+        mixer = self._room_mixers.get(self.room.get_peer_room(peer_id))
+        if mixer is not None:
+            mixer.remove_source(peer_id)
+        if state is not None:
+            if state.negotiation is not None:
+                state.negotiation.cancel()
+            task = asyncio.get_running_loop().create_task(self._close_connection(peer_id, state.pc))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        
+        # Forget the peer as a fanout source for everyone still listening
+        for listener in self.peers.values():
+            listener.senders.pop(peer_id, None)
+        room_id = self.room.get_peer_room(peer_id)
+        pending = self._pending_fanout.get(room_id)
+        if pending is not None:
+            pending.discard(peer_id)
+            if not pending:
+                del self._pending_fanout[room_id]
         self.room.leave(peer_id)
+        
+        # Stop any active recording while the connection closes in the
+        # background; this is the only teardown step remove_peer waits on
+        if peer_id in self.audio_handler.recorders:
+            await self.audio_handler.stop_recording(peer_id)
         logger.info(f"Cleaned up resources for peer {peer_id}")
 
+    async def remove_peers(self, peer_ids):
+        """Remove several peers at once, waiting until their connections are closed"""
+        await asyncio.gather(*(self.remove_peer(peer_id) for peer_id in peer_ids), return_exceptions=True)
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    async def _close_connection(self, peer_id: str, pc: RTCPeerConnection):
+        try:
+            await pc.close()
+        except Exception as e:
+            logger.error(f"Error closing connection for peer {peer_id}: {e}")
+
     def get_audio_track(self, peer_id: str) -> Optional[MediaStreamTrack]:
         """Get the audio track for a specific peer"""
-        return self.audio_tracks.get(peer_id)
+        state = self.peers.get(peer_id)
+        return state.track if state is not None else None
 
     def get_active_audio_peers(self) -> Set[str]:
         """Get all peer IDs that have active audio tracks"""
-        return set(self.audio_tracks.keys())
+        return set(self._audio_peers)
     
     def register_custom_audio_processor(self, name: str, processor):
         """Register a custom audio processor"""
@@ -422,10 +612,11 @@ class WebRTCHandler :
 
     def get_ice_connection_state(self, peer_id: str) -> Dict:
         """Get ICE connection state information for a specific peer"""
-        if peer_id not in self.connections:
+        state = self.peers.get(peer_id)
+        if state is None:
             return {"error": "Peer not found"}
         
-        pc = self.connections[peer_id]
+        pc = state.pc
         return {
             "peer_id": peer_id,
             "connection_state": pc.connectionState,
@@ -437,8 +628,8 @@ class WebRTCHandler :
     def get_audio_streaming_status(self, room_id: str = None) -> Dict:
         """Get detailed audio streaming status for debugging"""
         status = {
-            "total_connections": len(self.connections),
-            "total_audio_tracks": len(self.audio_tracks),
+            "total_connections": len(self.peers),
+            "total_audio_tracks": len(self._audio_peers),
             "active_rooms": len(self.room.rooms),
             "audio_statistics": self.get_all_audio_statistics()
         }
@@ -449,8 +640,9 @@ class WebRTCHandler :
                 "room_id": room_id,
                 "total_peers": len(room_peers),
                 "peers": list(room_peers),
-                "peers_with_audio": [peer_id for peer_id in room_peers if peer_id in self.audio_tracks],
-                "peers_with_connections": [peer_id for peer_id in room_peers if peer_id in self.connections]
+                # Set intersections against the indexes run in C
+                "peers_with_audio": list(room_peers & self._audio_peers),
+                "peers_with_connections": list(room_peers & self.peers.keys())
             }
         
         return status
@@ -458,23 +650,52 @@ class WebRTCHandler :
 
 
 
+_MAX_FRAME_SAMPLES = 5760  # 120 ms at 48 kHz, the longest Opus frame
+_UNIT_SCALE = np.float32(1.0)
+# PyAV sample format name -> NumPy dtype of its planes
+_AV_SAMPLE_DTYPES = {
+    "s16": np.int16, "s16p": np.int16,
+    "s32": np.int32, "s32p": np.int32,
+    "flt": np.float32, "fltp": np.float32,
+}
+# Integer sample type -> factor normalizing it to [-1, 1]
+_PCM_SCALE = {
+    np.int16: np.float32(1.0 / 32768.0),
+    np.int32: np.float32(1.0 / 2147483648.0),
+}
+
 class AudioPlayerTrack:
-    def __init__(self, track: MediaStreamTrack, target_rate: int = 48000, buffer_seconds: float = 0.3):
+    def __init__(self, track: MediaStreamTrack, target_rate: int = 48000, buffer_seconds: float = 0.03):
         """
         Play an incoming WebRTC MediaStreamTrack locally with smooth audio.
 
         :param track: incoming MediaStreamTrack (audio)
         :param target_rate: playback sample rate (usually 48000 for WebRTC)
-        :param buffer_seconds: how much audio to buffer (0.2–0.5 recommended)
+        :param buffer_seconds: most audio to buffer before dropping the oldest, rounded up
+            to whole 20 ms frames (30 ms default, so 40 ms)
         """
         self.track = track
         self.target_rate = target_rate
         self.channels = 2  # force stereo output
-        self.buffer = deque()
-        self.buffer_size = int(target_rate * buffer_seconds)
+        # Work in whole 20 ms WebRTC frames (960 samples at 48 kHz) so each
+        # recv() and each callback moves exactly one frame
+        self.frame_samples = target_rate // 50
+        self.buffer_size = max(1, -(-int(target_rate * buffer_seconds) // self.frame_samples)) * self.frame_samples
+        # Fixed single-producer/single-consumer ring of (samples, channels)
+        # float32 audio. The positions count samples ever written/read and are
+        # taken modulo the ring length; _run only advances _write_pos and the
+        # PortAudio callback only advances _read_pos, so neither side locks.
+        self._ring = np.zeros((self.buffer_size * 2, self.channels), dtype=np.float32)
+        self._write_pos = 0
+        self._read_pos = 0
+        self.dropped_frames = 0
+        self.unsupported_frames = 0
+        # Decoded frames are converted here before going into the ring
+        self._scratch = np.empty((_MAX_FRAME_SAMPLES, self.channels), dtype=np.float32)
         self._task = None
         self._stopped = asyncio.Event()
         self.stream = None
+        self._started = False
 
     def start(self):
         """Start playback in background"""
@@ -484,15 +705,12 @@ class AudioPlayerTrack:
             channels=self.channels,
             dtype='float32',
             callback=self._audio_callback,
-            blocksize=1024,
+            blocksize=self.frame_samples,
         )
 
-        # Start pulling frames
+        # Start pulling frames; _run starts the stream once one block is buffered
         self._task = asyncio.create_task(self._run())
 
-        # Start the stream after pre-filling some audio
-        asyncio.create_task(self._warmup())
-
     async def stop(self):
         """Stop playback"""
         self._stopped.set()
@@ -502,50 +720,100 @@ class AudioPlayerTrack:
             self.stream.stop()
             self.stream.close()
 
-    async def _warmup(self):
-        """Allow buffer to fill before starting playback"""
-        await asyncio.sleep(0.2)  # 200ms pre-buffer
-        if not self._stopped.is_set() and self.stream:
-            self.stream.start()
-
     async def _run(self):
         """Background: pull frames from WebRTC track and buffer them"""
         try:
             while not self._stopped.is_set():
                 frame: AudioFrame = await self.track.recv()
 
-                pcm = frame.to_ndarray()   # shape: (channels, samples)
-                pcm = np.transpose(pcm)    # → (samples, channels)
-
-                # Fix 1: normalize correctly depending on dtype
-                if pcm.dtype == np.int16:
-                    pcm = pcm.astype(np.float32) / 32768.0
-                elif pcm.dtype != np.float32:
-                    pcm = pcm.astype(np.float32)
+                # The callback isn't keeping up: drop the whole frame before
+                # converting it rather than converting audio that only pushes
+                # the buffered audio out again. Receiving it still drains
+                # aiortc's jitter buffer.
+                if self._buffered_samples >= self.buffer_size:
+                    self.dropped_frames += 1
+                    continue
+
+                dtype = _AV_SAMPLE_DTYPES.get(frame.format.name)
+                if dtype is None:
+                    self.unsupported_frames += 1
+                    continue
+
+                # View the frame's planes in place rather than copying them
+                # out with to_ndarray(); count skips the planes' padding
+                n = frame.samples
+                if frame.format.is_planar:
+                    left = np.frombuffer(frame.planes[0], dtype=dtype, count=n)
+                    right = np.frombuffer(frame.planes[-1], dtype=dtype, count=n)
+                else:
+                    channels = len(frame.layout.channels)
+                    interleaved = np.frombuffer(frame.planes[0], dtype=dtype, count=n * channels).reshape(n, channels)
+                    left, right = interleaved[:, 0], interleaved[:, -1]
 
-                # Fix 2: handle mono → duplicate to stereo
-                if pcm.shape[1] == 1:
-                    pcm = np.repeat(pcm, 2, axis=1)
+                # Normalize and spread to stereo in one pass per output
+                # channel; mono feeds both from the same row. This is the
+                # only copy the samples go through before the ring.
+                pcm = self._scratch_rows(n)
+                scale = _PCM_SCALE.get(dtype, _UNIT_SCALE)
+                np.multiply(left, scale, out=pcm[:, 0], casting='unsafe')
+                np.multiply(right, scale, out=pcm[:, 1], casting='unsafe')
 
-                # Add samples to ring buffer
-                for sample in pcm:
-                    self.buffer.append(sample)
+                self._ring_write(pcm)
 
-                # Trim buffer if too big
-                while len(self.buffer) > self.buffer_size:
-                    self.buffer.popleft()
+                # Start playback as soon as the first callback can be filled
+                if not self._started and self._buffered_samples >= min(self.stream.blocksize, self.buffer_size):
+                    self._started = True
+                    self.stream.start()
 
         except Exception as e:
-            print(f"Audio player error: {e}")
+            logger.error("Audio player error: %s", e)
+
+    def _scratch_rows(self, n: int) -> np.ndarray:
+        """(n, channels) view of the reused float32 conversion buffer"""
+        if n > len(self._scratch):
+            self._scratch = np.empty((n, self.channels), dtype=np.float32)
+        return self._scratch[:n]
+
+    @property
+    def _buffered_samples(self) -> int:
+        return self._write_pos - self._read_pos
+
+    def _ring_write(self, pcm: np.ndarray):
+        """Producer side: append samples in at most two slice copies.
+
+        Only the newest samples that fit in the ring next to the unread ones
+        are written, so an oversized frame (e.g. 60 ms Opus) never overwrites
+        audio the callback has yet to read. _run only writes while fewer than
+        buffer_size samples are buffered, so at least the newest buffer_size
+        samples, all the consumer keeps, always fit.
+        """
+        capacity = len(self._ring)
+        write_pos = self._write_pos
+        free = capacity - (write_pos - self._read_pos)
+        if len(pcm) > free:
+            # Older than anything the consumer would keep anyway
+            pcm = pcm[-free:]
+        n = len(pcm)
+        start = write_pos % capacity
+        first = min(n, capacity - start)
+        np.copyto(self._ring[start:start + first], pcm[:first])
+        np.copyto(self._ring[:n - first], pcm[first:])
+        # Publish only once the samples are in place
+        self._write_pos = write_pos + n
 
     def _audio_callback(self, outdata, frames, time, status):
         """Sounddevice realtime callback"""
-        chunk = []
-        for _ in range(frames):
-            if self.buffer:
-                chunk.append(self.buffer.popleft())
-            else:
-                # Fix 3: silence if underrun
-                chunk.append([0.0] * self.channels)
-
-        outdata[:] = np.array(chunk, dtype=np.float32)
\ No newline at end of file
+        capacity = len(self._ring)
+        write_pos = self._write_pos
+        read_pos = self._read_pos
+        # Consumer side: skip to the newest buffer_size samples if we fell behind
+        if write_pos - read_pos > self.buffer_size:
+            read_pos = write_pos - self.buffer_size
+        n = min(frames, write_pos - read_pos)
+        start = read_pos % capacity
+        first = min(n, capacity - start)
+        np.copyto(outdata[:first], self._ring[start:start + first])
+        np.copyto(outdata[first:n], self._ring[:n - first])
+        self._read_pos = read_pos + n
+        # Fix 3: silence if underrun
+        outdata[n:].fill(0)
\ No newline at end of file
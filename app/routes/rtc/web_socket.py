@@ -1,44 +1,171 @@
+import asyncio
+import hmac
 import json
 import logging
+import msgspec
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
 from fastapi.security import APIKeyHeader
-from typing import Optional, Dict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Optional, Dict, Set, Union
 from app.routes.rtc.web_rtc import WebRTCHandler
 from app.auth.dependencies import verify_api_key
-from app.config import API_KEY_HEADER_NAME, API_KEY
+from app.config import API_KEY_HASH, API_KEY_HEADER_NAME, hash_api_key
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# Signaling frames are serialized straight to UTF-8 bytes and sent as binary
+# frames; incoming frames are decoded by the msgspec message schemas below
+if orjson is not None:
+    _dumps = orjson.dumps
+else:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+# Fixed-shape replies, serialized once instead of per message
+_PONG_PREFIX = b'{"type":"pong","timestamp":'
+_ERR_INVALID_JSON = _dumps({"type": "error", "message": "Invalid JSON format"})
+
+@lru_cache(maxsize=128)
+def _err_bytes(message: str) -> bytes:
+    # A misbehaving client tends to repeat the same failure, so its replies
+    # are served from the cache instead of re-serialized each time
+    return _dumps({"type": "error", "message": message})
+
+@lru_cache(maxsize=1024)
+def _connection_established(user_id: str) -> bytes:
+    # User ids reconnect under the same name, so their greeting is cached
+    return _dumps({
+        "type": "connection_established",
+        "user_id": user_id,
+        "status": "connected"
+    })
+
 websocket_router = APIRouter()
 
+# Outbound frames buffered per client before it counts as too slow to keep
+_SEND_QUEUE_SIZE = 32
+# Frames queued together go out as one {"type":"batch","items":[...]} frame of
+# at most this many bytes; items are spliced in already serialized
+_BATCH_MAX_BYTES = 64 * 1024
+_BATCH_PREFIX = b'{"type":"batch","items":['
+_BATCH_SUFFIX = b"]}"
+
 # API key header for WebSocket authentication
 api_key_header = APIKeyHeader(name=API_KEY_HEADER_NAME, auto_error=False)
 
+@dataclass(slots=True)
+class Connection:
+    """A client's socket plus the queue and task that deliver its outbound frames"""
+    websocket: WebSocket
+    queue: asyncio.Queue
+    task: asyncio.Task
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.webrtc_handler = WebRTCHandler()
+        self.active_connections: Dict[str, Connection] = {}
+        self.webrtc_handler = WebRTCHandler(signal=self._signal)
+        self._closing: Set[asyncio.Task] = set()  # sockets being closed in the background
     
     async def connect(self, websocket: WebSocket, user_id: str):
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        queue = asyncio.Queue(maxsize=_SEND_QUEUE_SIZE)
+        task = asyncio.create_task(self._relay(user_id, websocket, queue))
+        previous = self.active_connections.get(user_id)
+        if previous is not None:
+            # Reconnected before the old socket was torn down; stop its relay
+            # and close it, so its receive loop stops acting as this user
+            previous.task.cancel()
+            self._close_in_background(previous.websocket, status.WS_1000_NORMAL_CLOSURE)
+        self.active_connections[user_id] = Connection(websocket, queue, task)
         logger.info(f"User {user_id} connected")
     
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            logger.info(f"User {user_id} disconnected")
+    async def _relay(self, user_id: str, websocket: WebSocket, queue: asyncio.Queue):
+        """Drain a client's queue onto its socket, so a slow client only ever
+        holds up its own frames"""
+        pending = None  # frame that didn't fit in the previous batch
+        try:
+            while True:
+                first = pending if pending is not None else await queue.get()
+                pending = None
+                # Coalesce whatever else is already queued into one frame
+                batch, size = [first], len(first)
+                while size < _BATCH_MAX_BYTES:
+                    try:
+                        message = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if size + len(message) > _BATCH_MAX_BYTES:
+                        pending = message
+                        break
+                    batch.append(message)
+                    size += len(message)
+                if len(batch) == 1:
+                    await websocket.send_bytes(first)
+                else:
+                    await websocket.send_bytes(_BATCH_PREFIX + b",".join(batch) + _BATCH_SUFFIX)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error sending message to user {user_id}: {e}")
+            self.disconnect(user_id, websocket)
     
-    async def send_personal_message(self, message: str, user_id: str):
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_text(message)
+    async def _signal(self, user_id: str, message: dict):
+        """Deliver a server-initiated signaling message, e.g. a renegotiation offer"""
+        await self.send_personal_message(_dumps(message), user_id)
     
-    async def broadcast(self, message: str):
-        for connection in self.active_connections.values():
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting message: {e}")
+    def disconnect(self, user_id: str, websocket: Optional[WebSocket] = None):
+        """Forget user_id's connection; given a websocket, only if it is still
+        that socket and not one the user has since reconnected with"""
+        connection = self.active_connections.get(user_id)
+        if connection is None or (websocket is not None and connection.websocket is not websocket):
+            return
+        del self.active_connections[user_id]
+        connection.task.cancel()
+        logger.info(f"User {user_id} disconnected")
+    
+    def _enqueue(self, user_id: str, connection: Connection, message: bytes):
+        try:
+            connection.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Signaling can't skip frames, so a client this far behind is dropped
+            logger.warning(f"Outbound queue full for user {user_id}, disconnecting")
+            self.disconnect(user_id)
+            self._close_in_background(connection.websocket, status.WS_1013_TRY_AGAIN_LATER)
+    
+    def _close_in_background(self, websocket: WebSocket, code: int):
+        task = asyncio.create_task(self._close(websocket, code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+    
+    async def _close(self, websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception as e:
+            logger.debug("Error closing WebSocket: %s", e)
+    
+    async def send_personal_message(self, message: bytes, user_id: str):
+        connection = self.active_connections.get(user_id)
+        if connection is not None:
+            self._enqueue(user_id, connection, message)
+    
+    async def broadcast_to_room(self, room_id: str, user_id: str, message: bytes):
+        """Send to everyone in room_id except user_id, looked up from the room
+        index rather than by scanning every connection"""
+        for member in self.webrtc_handler.room.others(room_id, user_id):
+            connection = self.active_connections.get(member)
+            if connection is not None:
+                self._enqueue(member, connection, message)
+    
+    async def broadcast(self, message: bytes):
+        # Snapshot: an overflowing client is disconnected mid-loop
+        for user_id, connection in tuple(self.active_connections.items()):
+            self._enqueue(user_id, connection, message)
 
 # Global connection manager instance
 manager = ConnectionManager()
@@ -49,19 +176,17 @@ async def verify_websocket_api_key(websocket: WebSocket) -> bool:
         # Get API key from query parameters or headers
         api_key = websocket.query_params.get("api_key") or websocket.headers.get(API_KEY_HEADER_NAME)
         
-        # Debug logging
-        logger.info(f"WebSocket connection attempt - API key provided: {bool(api_key)}")
-        logger.info(f"Expected API key: {API_KEY[:8]}..." if API_KEY else "None")
-        logger.info(f"Received API key: {api_key[:8]}..." if api_key else "None")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("WebSocket connection attempt - API key provided: %s", bool(api_key))
         
         if not api_key:
             logger.warning("No API key provided in WebSocket connection")
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Missing API key")
             return False
         
-        # Verify API key
-        if api_key != API_KEY:
-            logger.warning(f"Invalid API key provided: {api_key[:8]}...")
+        # Verify API key in constant time against the precomputed digest
+        if not hmac.compare_digest(hash_api_key(api_key), API_KEY_HASH):
+            logger.warning("Invalid API key provided")
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Invalid API key")
             return False
         
@@ -72,6 +197,14 @@ async def verify_websocket_api_key(websocket: WebSocket) -> bool:
         await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason="Authentication error")
         return False
 
+async def _receive_frame(websocket: WebSocket):
+    """Payload of the next text or binary frame, as str or bytes"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+    text = message.get("text")
+    return text if text is not None else message.get("bytes", b"")
+
 @websocket_router.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
     """WebSocket endpoint for real-time communication and WebRTC signaling"""
@@ -85,164 +218,186 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
         await manager.connect(websocket, user_id)
         logger.info(f"WebSocket connection established for user: {user_id}")
         # Send connection confirmation
-        await manager.send_personal_message(
-            json.dumps({
-                "type": "connection_established",
-                "user_id": user_id,
-                "status": "connected"
-            }), 
-            user_id
-        )
+        await manager.send_personal_message(_connection_established(user_id), user_id)
         
         # Handle incoming messages
         while True:
             try:
-                # Receive message from client
-                data = await websocket.receive_text()
-                message = json.loads(data)
-                logger.info(f"Received message: {message}")
-                # Handle different message types
-                await handle_websocket_message(message, user_id)
-                
-            except json.JSONDecodeError:
+                # Receive message from client; browsers send text frames,
+                # other clients may send binary, both parse without a decode
+                data = await _receive_frame(websocket)
+                logger.debug("Received message from user %s: %s", user_id, data)
+                message = _decoder.decode(data)
+            except msgspec.ValidationError as e:
+                await _reject_message(data, e, user_id)
+                continue
+            except msgspec.DecodeError:
                 logger.error(f"Invalid JSON received from user {user_id}")
-                await manager.send_personal_message(
-                    json.dumps({
-                        "type": "error",
-                        "message": "Invalid JSON format"
-                    }), 
-                    user_id
-                )
+                await manager.send_personal_message(_ERR_INVALID_JSON, user_id)
+                continue
+            
+            # Handle different message types
+            await handle_websocket_message(message, user_id)
                 
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected for user: {user_id}")
-        manager.disconnect(user_id)
     except Exception as e:
         logger.error(f"Error in WebSocket connection for user {user_id}: {e}")
-        manager.disconnect(user_id)
+    finally:
+        # Also runs on cancellation (server shutdown), so no entry outlives its socket
+        manager.disconnect(user_id, websocket)
+
+# Incoming signaling messages, one Struct per "type"; decoding validates the
+# fields in the same pass, so handlers read attributes instead of .get() chains.
+# Fields a client sends beyond these (e.g. peerId) are ignored.
+class _Message(msgspec.Struct, tag_field="type"):
+    pass
+
+class Offer(_Message, tag="offer"):
+    roomId: str
+    offer: dict
+
+class Answer(_Message, tag="answer"):
+    answer: dict
+
+class IceCandidate(_Message, tag="ice-candidate"):
+    roomId: str
+    candidate: Optional[dict] = None  # null once the client finished gathering
+
+class JoinRoom(_Message, tag="join-room"):
+    roomId: str
+
+class LeaveRoom(_Message, tag="leave-room"):
+    roomId: str
+
+class Ping(_Message, tag="ping"):
+    timestamp: Any = None
+
+class _Envelope(msgspec.Struct):
+    """Just the type of a message that failed validation, to word the error"""
+    type: Any = None
+
+_decoder = msgspec.json.Decoder(Union[Offer, Answer, IceCandidate, JoinRoom, LeaveRoom, Ping])
+_envelope_decoder = msgspec.json.Decoder(_Envelope)
+
+async def _handle_offer(message: Offer, user_id: str):
+    """Handle a WebRTC offer"""
+    # Create peer connection and handle offer
+    answer = await manager.webrtc_handler.handle_offer(message.roomId, user_id, message.offer)
+    
+    # Send answer back to client
+    await manager.send_personal_message(
+        _dumps({
+            "type": "answer",
+            "roomId": message.roomId,
+            "answer": answer
+        }), 
+        user_id
+    )
 
-async def handle_websocket_message(message: dict, user_id: str):
+async def _handle_answer(message: Answer, user_id: str):
+    """Handle a WebRTC answer"""
+    await manager.webrtc_handler.handle_answer(user_id, message.answer)
+
+async def _handle_ice_candidate(message: IceCandidate, user_id: str):
+    """Handle a WebRTC ICE candidate"""
+    if message.candidate:
+        await manager.webrtc_handler.handle_candidate(message.roomId, user_id, message.candidate)
+
+async def _handle_join_room(message: JoinRoom, user_id: str):
+    """Handle room joining"""
+    room_id = message.roomId
+    # Join the WebRTC room (not async)
+    manager.webrtc_handler.room.join(room_id, user_id)
+    
+    await manager.send_personal_message(
+        _dumps({
+            "type": "room-joined",
+            "roomId": room_id,
+            "peerId": user_id
+        }), 
+        user_id
+    )
+    
+    # Notify other users in the room
+    await manager.broadcast_to_room(
+        room_id,
+        user_id,
+        _dumps({
+            "type": "user-joined-room",
+            "roomId": room_id,
+            "peerId": user_id
+        })
+    )
+
+async def _handle_leave_room(message: LeaveRoom, user_id: str):
+    """Handle room leaving"""
+    room_id = message.roomId
+    # Leave the WebRTC room (not async)
+    manager.webrtc_handler.room.leave(user_id)
+    
+    await manager.send_personal_message(
+        _dumps({
+            "type": "room-left",
+            "roomId": room_id,
+            "peerId": user_id
+        }), 
+        user_id
+    )
+    
+    # Notify other users in the room
+    await manager.broadcast_to_room(
+        room_id,
+        user_id,
+        _dumps({
+            "type": "user-left-room",
+            "roomId": room_id,
+            "peerId": user_id
+        })
+    )
+
+async def _handle_ping(message: Ping, user_id: str):
+    """Handle ping for connection health check"""
+    await manager.send_personal_message(
+        _PONG_PREFIX + _dumps(message.timestamp) + b"}",
+        user_id
+    )
+
+# Message struct -> handler(message, user_id)
+HANDLERS: Dict[type, Callable[[Any, str], Awaitable[None]]] = {
+    Offer: _handle_offer,
+    Answer: _handle_answer,
+    IceCandidate: _handle_ice_candidate,
+    JoinRoom: _handle_join_room,
+    LeaveRoom: _handle_leave_room,
+    Ping: _handle_ping,
+}
+_MESSAGE_TYPES = frozenset(cls.__struct_config__.tag for cls in HANDLERS)
+
+async def _reject_message(data, error: msgspec.ValidationError, user_id: str):
+    """Reply to a well-formed JSON frame that isn't a valid message"""
+    try:
+        message_type = _envelope_decoder.decode(data).type
+    except msgspec.DecodeError:
+        message_type = None
+    if message_type in _MESSAGE_TYPES:
+        logger.error(f"Invalid {message_type} message from user {user_id}: {error}")
+        reply = _err_bytes(f"Error processing message: {error}")
+    else:
+        # Unknown message type
+        logger.warning(f"Unknown message type '{message_type}' from user {user_id}")
+        reply = _err_bytes(f"Unknown message type: {message_type}")
+    await manager.send_personal_message(reply, user_id)
+
+async def handle_websocket_message(message: _Message, user_id: str):
     """Handle different types of WebSocket messages"""
     
-    print("hello", message)
-    message_type = message.get("type")
-    logger.info(f"Received message: {message_type}")
+    logger.debug("Received message: %s", message.__struct_config__.tag)
     try:
-        if message_type == "offer":
-            # Handle WebRTC offer
-            room_id = message.get("roomId")
-            offer = message.get("offer")
-            
-            if not room_id or not offer:
-                raise ValueError("Missing roomId or offer")
-            
-            # Create peer connection and handle offer
-            answer = await manager.webrtc_handler.handle_offer(room_id, user_id, offer)
-            
-            # Send answer back to client
-            await manager.send_personal_message(
-                json.dumps({
-                    "type": "answer",
-                    "roomId": room_id,
-                    "answer": answer
-                }), 
-                user_id
-            )
-            
-        elif message_type == "answer":
-            # Handle WebRTC answer
-            answer = message.get("answer")
-            if answer:
-                await manager.webrtc_handler.handle_answer(user_id, answer)
-                
-        elif message_type == "ice-candidate":
-            # Handle WebRTC ICE candidate
-            room_id = message.get("roomId")
-            candidate = message.get("candidate")
-            
-            if room_id and candidate:
-                await manager.webrtc_handler.handle_candidate(room_id, user_id, candidate)
-                
-        elif message_type == "join-room":
-            # Handle room joining
-            room_id = message.get("roomId")
-            if room_id:
-                # Join the WebRTC room (not async)
-                manager.webrtc_handler.room.join(room_id, user_id)
-                
-                await manager.send_personal_message(
-                    json.dumps({
-                        "type": "room-joined",
-                        "roomId": room_id,
-                        "peerId": user_id
-                    }), 
-                    user_id
-                )
-                
-                # Notify other users in the room
-                await manager.broadcast(
-                    json.dumps({
-                        "type": "user-joined-room",
-                        "roomId": room_id,
-                        "peerId": user_id
-                    })
-                )
-                
-        elif message_type == "leave-room":
-            # Handle room leaving
-            room_id = message.get("roomId")
-            if room_id:
-                # Leave the WebRTC room (not async)
-                manager.webrtc_handler.room.leave(user_id)
-                
-                await manager.send_personal_message(
-                    json.dumps({
-                        "type": "room-left",
-                        "roomId": room_id,
-                        "peerId": user_id
-                    }), 
-                    user_id
-                )
-                
-                # Notify other users in the room
-                await manager.broadcast(
-                    json.dumps({
-                        "type": "user-left-room",
-                        "roomId": room_id,
-                        "peerId": user_id
-                    })
-                )
-                
-        elif message_type == "ping":
-            # Handle ping for connection health check
-            await manager.send_personal_message(
-                json.dumps({
-                    "type": "pong",
-                    "timestamp": message.get("timestamp")
-                }), 
-                user_id
-            )
-            
-        else:
-            # Unknown message type
-            logger.warning(f"Unknown message type '{message_type}' from user {user_id}")
-            await manager.send_personal_message(
-                json.dumps({
-                    "type": "error",
-                    "message": f"Unknown message type: {message_type}"
-                }), 
-                user_id
-            )
-            
+        await HANDLERS[type(message)](message, user_id)
     except Exception as e:
         logger.error(f"Error handling message from user {user_id}: {e}")
-        await manager.send_personal_message(
-            json.dumps({
-                "type": "error",
-                "message": f"Error processing message: {str(e)}"
-            }), 
-            user_id
-        )
+        await manager.send_personal_message(_err_bytes(f"Error processing message: {e}"), user_id)
 
 @websocket_router.get("/health")
 async def health_check():
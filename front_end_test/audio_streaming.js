@@ -313,6 +313,8 @@ class AudioStreamingApp {
                 // Construct WebSocket URL with API key as query parameter
                 const wsUrl = `${this.serverUrl}?api_key=${encodeURIComponent(this.apiKey)}`;
                 this.websocket = new WebSocket(wsUrl);
+                // Server frames are binary UTF-8 JSON
+                this.websocket.binaryType = 'arraybuffer';
                 
                 this.websocket.onopen = () => {
                     this.log('WebSocket connection established', 'success');
@@ -325,7 +327,13 @@ class AudioStreamingApp {
                 };
 
                 this.websocket.onmessage = (event) => {
-                    this.handleWebSocketMessage(JSON.parse(event.data));
+                    const text = typeof event.data === 'string'
+                        ? event.data
+                        : new TextDecoder().decode(event.data);
+                    const message = JSON.parse(text);
+                    // The server coalesces queued messages into one batch frame
+                    const messages = message.type === 'batch' ? message.items : [message];
+                    messages.forEach((item) => this.handleWebSocketMessage(item));
                 };
 
                 this.websocket.onerror = (error) => {
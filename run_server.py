@@ -10,6 +10,8 @@ import uvicorn
 # Add the app directory to Python path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
 
+from app.config import USE_UVLOOP
+
 if __name__ == "__main__":
     print("Starting IEC Translate WebSocket Server...")
     print("Server will be available at: http://localhost:8000")
@@ -18,14 +20,28 @@ if __name__ == "__main__":
     print("Press Ctrl+C to stop the server")
     print("-" * 50)
     
+    # Rooms, peer connections and sockets live in process memory, so the
+    # server runs a single worker; peers of one room on different workers
+    # would never see each other
+    if os.getenv("WORKERS", "1") != "1":
+        print("Error: WORKERS must be 1; rooms and peer connections are per-process state")
+        sys.exit(1)
+    dev = os.getenv("DEV") == "1"
+    
     try:
         uvicorn.run(
             "main:app",
             host="0.0.0.0",
             port=8000,
-            reload=True,
+            reload=dev,  # Reload spawns a file watcher, development only
+            workers=1,
+            loop="uvloop" if USE_UVLOOP else "asyncio",  # libuv-based event loop
+            http="httptools",  # C HTTP parser
+            ws="websockets",
+            ws_ping_interval=20,  # Protocol-level keepalive: peers that vanish
+            ws_ping_timeout=20,   # without a close frame are dropped within ~40s
             log_level="info",
-            access_log=True
+            access_log=dev  # Access logs are a write per request, development only
         )
     except KeyboardInterrupt:
         print("\nServer stopped by user")
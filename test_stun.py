@@ -1,39 +1,55 @@
 import asyncio
+import os
 import socket
 import struct
 import time
 
+# STUN Binding Request header, without the transaction ID
+# Message Type: Binding Request (0x0001)
+# Message Length: 0 (no attributes)
+# Magic Cookie: 0x2112A442
+_STUN_HDR = struct.pack('!HHL', 0x0001, 0x0000, 0x2112A442)
+
+class StunProtocol(asyncio.DatagramProtocol):
+    """Resolves a future with the first response carrying our transaction ID"""
+
+    def __init__(self, transaction_id):
+        self.transaction_id = transaction_id
+        self.response = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        # Bytes 8-20 of a STUN message echo the request's transaction ID
+        if data[8:20] == self.transaction_id and not self.response.done():
+            self.response.set_result(data)
+
+    def error_received(self, exc):
+        if not self.response.done():
+            self.response.set_exception(exc)
+
 async def test_stun_server(host, port):
     """Test individual STUN server connectivity"""
+    transport = None
     try:
-        # Create UDP socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(5.0)
-        
-        # STUN Binding Request message
-        # Message Type: Binding Request (0x0001)
-        # Message Length: 0 (no attributes)
-        # Magic Cookie: 0x2112A442
-        # Transaction ID: 12 random bytes
-        msg_type = struct.pack('!H', 0x0001)
-        msg_length = struct.pack('!H', 0x0000)
-        magic_cookie = struct.pack('!L', 0x2112A442)
-        transaction_id = b'\x00' * 12
-        
-        stun_request = msg_type + msg_length + magic_cookie + transaction_id
+        # Transaction ID: 12 random bytes, so the response can be matched
+        transaction_id = os.urandom(12)
+        stun_request = _STUN_HDR + transaction_id
         
         print(f"Testing STUN server {host}:{port}...")
         start_time = time.time()
         
-        sock.sendto(stun_request, (host, port))
-        response, addr = sock.recvfrom(1024)
+        # Non-blocking UDP endpoint, so every server can be probed at once
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: StunProtocol(transaction_id), remote_addr=(host, port), family=socket.AF_INET
+        )
+        transport.sendto(stun_request)
+        response = await asyncio.wait_for(protocol.response, 5.0)
         
         elapsed = time.time() - start_time
         print(f"✅ {host}:{port} responded in {elapsed:.3f}s (response length: {len(response)} bytes)")
-        sock.close()
         return True
         
-    except socket.timeout:
+    except asyncio.TimeoutError:
         print(f"❌ {host}:{port} - Timeout (no response)")
         return False
     except socket.gaierror as e:
@@ -43,10 +59,8 @@ async def test_stun_server(host, port):
         print(f"❌ {host}:{port} - Error: {e}")
         return False
     finally:
-        try:
-            sock.close()
-        except:
-            pass
+        if transport is not None:
+            transport.close()
 
 async def test_all_stun_servers():
     """Test all your STUN servers"""
@@ -65,11 +79,9 @@ async def test_all_stun_servers():
     
     print("Testing STUN server connectivity...\n")
     
-    working_servers = []
-    for host, port in stun_servers:
-        if await test_stun_server(host, port):
-            working_servers.append((host, port))
-        await asyncio.sleep(0.1)  # Small delay between tests
+    # Probe every server concurrently; total time is the slowest probe
+    results = await asyncio.gather(*(test_stun_server(host, port) for host, port in stun_servers))
+    working_servers = [server for server, ok in zip(stun_servers, results) if ok]
     
     print(f"\nSummary: {len(working_servers)}/{len(stun_servers)} STUN servers are reachable")
     